@@ -0,0 +1,171 @@
+"""times and memory of each stage over synthetic workbooks, compared
+against a stored baseline
+
+run from the repository root:
+python -m benchmarks.stages --quarters 16 --funds 1500 --save baseline.json
+python -m benchmarks.stages --quarters 16 --funds 1500 --compare baseline.json
+
+seconds are the best of repeats, peak_mb the peak python allocation
+traced by tracemalloc in a run of its own; compare exits 1 should any
+stage be slower or hungrier than the baseline by more than tolerance
+"""
+
+from utilities.data_cleaner import AnalysisCleaner, CISFundsCleaner
+from utilities.preprocessing import FlowExtractor, FlowStandardiser
+from utilities.synthetic import generate_workbooks
+from utilities.star_schema import FlowStarSchema
+from utilities.export import ExcelExport
+import pandas as pd
+import tracemalloc
+import tempfile
+import argparse
+import json
+import time
+import sys
+import os
+
+
+def benchmark(quarters=8, funds=500, repeats=3):
+    """stage, seconds and peak_mb per stage, the workbooks generated once"""
+    excel_files = generate_workbooks(quarters, funds)
+    inputs = {"excel_files": excel_files}
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        inputs["path"] = os.path.join(directory, "star_schema.xlsx")
+
+        for name, stage in _stages():
+            seconds = min(_timed(stage, inputs) for _ in range(repeats))
+            peak_mb = _traced(stage, inputs)
+            inputs[name] = stage(inputs)
+
+            results.append((name, round(seconds, 4), round(peak_mb, 2)))
+
+    return pd.DataFrame(
+        data=results,
+        columns=["Stage", "Seconds", "Peak_MB"],
+    ).set_index("Stage")
+
+
+def compare(results, baseline, tolerance=0.2):
+    """ratios of results to baseline, a stage regressed where either ratio
+    exceeds 1 + tolerance
+    """
+    comparison = results.join(baseline, rsuffix="_Baseline", how="left")
+
+    comparison["Seconds_Ratio"] = comparison.Seconds / comparison.Seconds_Baseline
+    comparison["Peak_MB_Ratio"] = comparison.Peak_MB / comparison.Peak_MB_Baseline
+
+    ratios = comparison[["Seconds_Ratio", "Peak_MB_Ratio"]]
+    comparison["Regressed"] = (ratios > 1 + tolerance).any(axis="columns")
+
+    return comparison.round(3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quarters", type=int, default=8)
+    parser.add_argument("--funds", type=int, default=500)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--save", help="baseline json written")
+    parser.add_argument("--compare", help="baseline json compared against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    results = benchmark(args.quarters, args.funds, args.repeats)
+    config = {"quarters": args.quarters, "funds": args.funds}
+
+    if args.save is not None:
+        with open(args.save, "w") as file:
+            json.dump(
+                {"config": config, "stages": results.to_dict(orient="index")},
+                file,
+                indent=2,
+            )
+
+    if args.compare is None:
+        print(results.to_string())
+        return 0
+
+    with open(args.compare) as file:
+        stored = json.load(file)
+
+    if stored["config"] != config:
+        print(f"baseline ran on {stored['config']}, not {config}")
+
+    baseline = pd.DataFrame.from_dict(stored["stages"], orient="index")
+    comparison = compare(results, baseline, args.tolerance)
+    print(comparison.to_string())
+
+    return int(comparison.Regressed.any())
+
+
+def _stages():
+    """name and stage, each stage a function of the outputs before it"""
+
+    def extract(inputs):
+        return FlowExtractor().extract_workbooks(
+            inputs["excel_files"], Analysis=0, CISFunds=2
+        )
+
+    def standardise(inputs):
+        standardiser = FlowStandardiser()
+        extracted = inputs["extract"]
+        return [standardiser.standardise(extracted[sheet]) for sheet in extracted]
+
+    def clean_analysis(inputs):
+        analysis, _ = inputs["standardise"]
+        return AnalysisCleaner(analysis)
+
+    def clean_cis_funds(inputs):
+        _, cis_funds = inputs["standardise"]
+        return CISFundsCleaner(cis_funds).cis_funds
+
+    def update(inputs):
+        cleaner = inputs["clean_analysis"]
+        return cleaner.update(cleaner.analysis, inputs["clean_cis_funds"])
+
+    def star_schema(inputs):
+        cis_funds = inputs["clean_cis_funds"]
+        return FlowStarSchema(
+            analysis=inputs["update"],
+            cis_funds_fund_data=cis_funds["funds_operational"],
+            cis_funds_sector_data=cis_funds["sectors"],
+        )
+
+    def to_excel(inputs):
+        export = ExcelExport(inputs["path"], streaming=False)
+        return inputs["star_schema"].export(export)
+
+    return [
+        ("extract", extract),
+        ("standardise", standardise),
+        ("clean_analysis", clean_analysis),
+        ("clean_cis_funds", clean_cis_funds),
+        ("update", update),
+        ("star_schema", star_schema),
+        ("to_excel", to_excel),
+    ]
+
+
+def _timed(stage, inputs):
+    start = time.perf_counter()
+    stage(inputs)
+    return time.perf_counter() - start
+
+
+def _traced(stage, inputs):
+    """peak traced allocation, in MB"""
+    tracemalloc.start()
+
+    try:
+        stage(inputs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak / 2**20
+
+
+if __name__ == "__main__":
+    sys.exit(main())
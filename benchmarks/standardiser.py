@@ -0,0 +1,142 @@
+"""FlowStandardiser against the implementation it replaced, on the same
+extracted sheets of a synthetic quarter history
+
+run from the repository root:
+python -m benchmarks.standardiser --quarters 56 --funds 1500
+
+seconds are the best of repeats; the outputs of both are asserted equal
+before any timing is reported
+"""
+
+from utilities.preprocessing import FlowExtractor, FlowStandardiser
+from utilities.synthetic import generate_workbooks
+from copy import deepcopy
+import pandas as pd
+import argparse
+import time
+import sys
+
+
+def benchmark(quarters=56, funds=1500, repeats=3):
+    """sheet, shape and seconds of the legacy and current standardiser"""
+    excel_files = generate_workbooks(quarters, funds)
+    extracted = FlowExtractor().extract_workbooks(excel_files, Analysis=0, CISFunds=2)
+    results = []
+
+    for sheet_name, sheets in extracted.items():
+        legacy = _LegacyStandardiser().standardise(sheets)
+        current = FlowStandardiser().standardise(sheets)
+        pd.testing.assert_frame_equal(legacy, current)
+
+        legacy_seconds = min(
+            _timed(_LegacyStandardiser().standardise, sheets) for _ in range(repeats)
+        )
+        current_seconds = min(
+            _timed(FlowStandardiser().standardise, sheets) for _ in range(repeats)
+        )
+
+        results.append(
+            (
+                sheet_name,
+                f"{current.shape[0]} x {current.shape[1]}",
+                round(legacy_seconds, 4),
+                round(current_seconds, 4),
+                round(legacy_seconds / current_seconds, 2),
+            )
+        )
+
+    return pd.DataFrame(
+        data=results,
+        columns=["Sheet", "Shape", "Legacy_Seconds", "Seconds", "Speed_Up"],
+    ).set_index("Sheet")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quarters", type=int, default=56)
+    parser.add_argument("--funds", type=int, default=1500)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(benchmark(args.quarters, args.funds, args.repeats).to_string())
+    return 0
+
+
+class _LegacyStandardiser:
+    """FlowStandardiser as it was before the vectorised single pass, kept
+    as the reference the current one is timed and checked against
+    """
+
+    _corrective_char_regex = [
+        ("[(|)|/]", ""),
+        ("\\s+", "_"),
+    ]
+
+    _corrective_headers = [
+        ("Category1", "Geography"),
+        ("Category2", "Allocation"),
+        ("Category3", "Portfolio"),
+        ("FoF", "Fund_of_Funds"),
+        ("Fundname", "Fund_Name"),
+        ("Sector_Name", "Sector_Classification"),
+    ]
+
+    _date_key = "Date_Key"
+
+    def standardise(self, sheets):
+        sheets = deepcopy(sheets)
+
+        sheets_std_header = {
+            date: self._standardise_header(sheet) for date, sheet in sheets.items()
+        }
+
+        sheets_no_lead_trail_whitespace = {
+            date: self._strip_lead_trail_whitespace_from_values(sheet)
+            for date, sheet in sheets_std_header.items()
+        }
+
+        return self._flatten(sheets_no_lead_trail_whitespace)
+
+    def _flatten(self, sheets):
+        for date, sheet in sheets.items():
+            sheet[self._date_key] = date
+            sheet.index.name = self._date_key
+            sheets[date] = sheet
+
+        sheets_flat = pd.concat(sheet for sheet in sheets.values())
+
+        return sheets_flat.set_index(self._date_key)
+
+    def _standardise_header(self, sheet):
+        corrective_pairings = [
+            self._corrective_char_regex,
+            self._corrective_headers,
+        ]
+
+        for pairings in corrective_pairings:
+            for pattern, replace in pairings:
+                sheet.columns = sheet.columns.str.replace(pattern, replace, regex=True)
+
+        return sheet
+
+    @staticmethod
+    def _strip_lead_trail_whitespace_from_values(sheet):
+        objs = sheet.dtypes == "object"
+
+        is_str = objs[objs].index
+        str_ = sheet[is_str].astype(str).applymap(str.upper).applymap(str.strip)
+
+        is_not_str = objs[~objs].index
+        str_not = sheet[is_not_str]
+
+        return pd.concat([str_, str_not], axis="columns")
+
+
+def _timed(standardise, sheets):
+    start = time.perf_counter()
+    standardise(sheets)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,4 +10,7 @@ setup(
     description="Prep CIS Fund and Analysis sheets for Star Schema",
     packages=["utilities"],
     package_requires=requirements,
+    entry_points={
+        "console_scripts": ["asisa-flows=utilities.pipeline:main"],
+    },
 )
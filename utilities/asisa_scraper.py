@@ -1,23 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from collections import Counter
 from lxml import html
+import functools
 import requests
+import hashlib
+import shutil
+import time
+import os
 
 
-def scrape_excel(file):
-    report_urls = _get_report_urls(file)
-    return [requests.get(url).content for url in report_urls]
+BASE_URL = "https://www.asisa.org.za/"
+STATS_PAGE = "statistics/collective-investments-schemes/local-fund-statistics/"
 
+_chunk_size = 1024 * 1024
+_retry_statuses = {429, 500, 502, 503, 504}
 
-def _get_report_urls(file):
+
+def scrape_excel(
+    file,
+    workers=1,
+    retries=3,
+    backoff=0.5,
+    download_dir=None,
+    cache=None,
+    offline=False,
+    revalidate=True,
+    base_url=BASE_URL,
+):
+    """workbooks returned in the order their links appear on the stats page
+
+    workers > 1 downloads concurrently over one pooled session
+    download_dir streams each body to disk, returning paths in place of bytes
+
+    cache, a WorkbookCache, keeps every body on disk between runs:
+    a cached link is revalidated with a conditional request, or not
+    requested at all without revalidate, and offline serves the stats
+    page and workbooks from the cache alone
+    """
+    with create_session(workers) as session:
+        fetch = functools.partial(
+            _fetch,
+            session,
+            retries=retries,
+            backoff=backoff,
+            download_dir=download_dir,
+            cache=cache,
+            offline=offline,
+            revalidate=revalidate,
+        )
+
+        report_urls = _get_report_urls(file, base_url=base_url, fetch=fetch)
+
+        if download_dir is not None:
+            _check_download_names(report_urls)
+
+        if workers <= 1:
+            workbooks = [fetch(url) for url in report_urls]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                workbooks = list(executor.map(fetch, report_urls))
+
+    if cache is not None:
+        # the stats page, fetched first, would otherwise go first
+        cache.evict(keep={f"{base_url}{STATS_PAGE}"})
+
+    return workbooks
+
+
+def create_session(workers=1):
+    """connection pool sized so no worker waits on a free connection"""
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def _check_download_names(urls):
+    """each url written to a file of its own, two links to the same
+    workbook would race for one file
+    """
+    names = Counter(_download_name(url) for url in urls)
+    duplicated = sorted(name for name, count in names.items() if count > 1)
+
+    if duplicated:
+        raise ValueError(f"links share download names: {duplicated}")
+
+
+def _copy_from_cache(cached, url, download_dir):
+    if download_dir is None:
+        with open(cached, "rb") as file:
+            return file.read()
+
+    if not os.path.isdir(download_dir):
+        os.makedirs(download_dir)
+
+    path = os.path.join(download_dir, _download_name(url))
+    shutil.copyfile(cached, path)
+    return path
+
+
+def _download_name(url):
+    """file name of the link, tagged with a digest of its whole path, the
+    same file name being used in different upload folders
+    """
+    url_path = urlparse(url).path
+    stem, extension = os.path.splitext(os.path.basename(url_path))
+    digest = hashlib.sha256(url_path.encode()).hexdigest()[:10]
+
+    return f"{stem}-{digest}{extension}"
+
+
+def _fetch(
+    session,
+    url,
+    retries=3,
+    backoff=0.5,
+    download_dir=None,
+    cache=None,
+    offline=False,
+    revalidate=True,
+):
+    """retries connection errors and transient statuses, backing off
+    exponentially: backoff, 2 * backoff, 4 * backoff, ...
+    """
+    for attempt in range(retries + 1):
+        try:
+            if cache is not None:
+                cached = cache.get(session, url, offline, revalidate)
+                return _copy_from_cache(cached, url, download_dir)
+
+            with session.get(url, stream=download_dir is not None) as response:
+                response.raise_for_status()
+
+                if download_dir is None:
+                    return response.content
+
+                return _stream_to_disk(response, url, download_dir)
+        except requests.RequestException as error:
+            status = getattr(error.response, "status_code", None)
+            transient = status is None or status in _retry_statuses
+
+            if not transient or attempt == retries:
+                raise
+
+            time.sleep(backoff * 2**attempt)
+
+
+def _get_report_urls(file, base_url=BASE_URL, fetch=None):
     """source inconsistencies:
     file extentions used are 'xls' and 'xlsx'
     file naming is singular and plural
+
+    the page itself is always revalidated, new links only appear there
     """
-    base_url = "https://www.asisa.org.za/"
-    stats_page = "statistics/collective-investments-schemes/local-fund-statistics/"
+    stats_page_url = f"{base_url}{STATS_PAGE}"
 
-    response = requests.get(f"{base_url}{stats_page}")
+    if fetch is None:
+        content = requests.get(stats_page_url).content
+    else:
+        content = fetch(stats_page_url, download_dir=None, revalidate=True)
 
-    page = html.fromstring(response.content)
+    page = html.fromstring(content)
     urls_on_page = page.xpath("//a/@href")
 
     return [f"{base_url}{url}" for url in urls_on_page if "xls" in url and file in url]
+
+
+def _stream_to_disk(response, url, download_dir):
+    """written under a temporary name first, a partial download never
+    masquerades as a complete workbook
+    """
+    if not os.path.isdir(download_dir):
+        os.makedirs(download_dir)
+
+    path = os.path.join(download_dir, _download_name(url))
+    partial = f"{path}.part"
+
+    try:
+        with open(partial, "wb") as file:
+            for chunk in response.iter_content(chunk_size=_chunk_size):
+                file.write(chunk)
+    except BaseException:
+        os.remove(partial)
+        raise
+
+    os.replace(partial, path)
+    return path
@@ -0,0 +1,312 @@
+from utilities.sheet_cache import nan_for_null
+import pyarrow.feather as feather
+import pyarrow as pa
+import pandas as pd
+import hashlib
+import numbers
+import pickle
+import shutil
+import json
+import os
+
+
+_tag_types = [
+    ("bool", bool),
+    ("int", numbers.Integral),
+    ("float", numbers.Real),
+    ("str", str),
+]
+
+_tag_restore = {
+    "none": lambda value: None,
+    "bool": lambda value: value == "True",
+    "int": int,
+    "float": float,
+    "str": str,
+}
+
+
+def fingerprint(output):
+    """sha256 of a stage output: frames by their values, index and columns,
+    lists and dicts of frames item by item, anything else by its json
+    """
+    sha256 = hashlib.sha256()
+
+    for key, frame in _frames(output):
+        sha256.update(key.encode())
+        sha256.update(repr(list(frame.columns)).encode())
+        sha256.update(repr(frame.dtypes.astype(str).tolist()).encode())
+        sha256.update(pd.util.hash_pandas_object(frame).to_numpy().tobytes())
+
+    sha256.update(json.dumps(_layout(output), default=str).encode())
+    return sha256.hexdigest()
+
+
+class FlowCheckpoints:
+    """stage outputs kept under directory as arrow ipc (feather v2) files,
+    uncompressed, one per frame, so that a later stage or another process
+    memory maps them rather than unpickling them
+
+    each stage's manifest holds the fingerprint of the inputs its output
+    was computed from, a checkpoint is valid only for that fingerprint.
+    object columns arrow would not hold as text or bytes, ints mixed with
+    strings say, are written as str beside a column tagging each value's type, and
+    restored from it on load; frames with values of other types in those
+    columns, or with non-str or repeated column names, are pickled instead
+
+    layout:
+    <directory>/<stage>/manifest.json, fingerprint, layout and file formats
+    <directory>/<stage>/<key>.arrow, a frame of the output
+    <directory>/<stage>/<key>.pkl, a frame arrow cannot hold
+    """
+
+    _manifest_name = "manifest.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def fingerprint_of(self, stage):
+        manifest = self._read_manifest(stage)
+        return None if manifest is None else manifest["fingerprint"]
+
+    def invalidate(self, stage=None):
+        """drop one stage's checkpoint, or every checkpoint if no stage given"""
+        stages = os.listdir(self.directory) if stage is None else [stage]
+
+        for name in stages:
+            shutil.rmtree(self._path(name), ignore_errors=True)
+
+    def is_valid(self, stage, fingerprint):
+        return fingerprint is not None and self.fingerprint_of(stage) == fingerprint
+
+    def load(self, stage):
+        """output of stage as saved, frames read from memory maps, columns
+        arrow holds without nulls left as views of the file
+        """
+        manifest = self._read_manifest(stage)
+
+        if manifest is None:
+            raise FileNotFoundError(
+                f"no checkpoint of stage {stage} in {self.directory}"
+            )
+
+        frames = {
+            key: self._read_frame(stage, key, file_format)
+            for key, file_format in manifest["formats"].items()
+        }
+
+        return _from_layout(manifest["layout"], frames)
+
+    def save(self, stage, output, fingerprint):
+        """output a frame, a list or dict of frames, or anything json holds;
+        written beside any earlier checkpoint, swapped in once complete
+        """
+        part = self._path(f"{stage}.part")
+        shutil.rmtree(part, ignore_errors=True)
+        os.makedirs(part)
+
+        formats = {
+            key: self._write_frame(part, key, frame) for key, frame in _frames(output)
+        }
+
+        manifest = {
+            "fingerprint": fingerprint,
+            "layout": _layout(output),
+            "formats": formats,
+        }
+
+        with open(os.path.join(part, self._manifest_name), "w") as file:
+            json.dump(manifest, file, indent=1)
+
+        shutil.rmtree(self._path(stage), ignore_errors=True)
+        os.replace(part, self._path(stage))
+
+    def _path(self, stage, *names):
+        return os.path.join(self.directory, stage, *names)
+
+    def _read_frame(self, stage, key, file_format):
+        if file_format == "pickle":
+            with open(self._path(stage, f"{key}.pkl"), "rb") as file:
+                return pickle.load(file)
+
+        source = pa.memory_map(self._path(stage, f"{key}.arrow"))
+        table = pa.ipc.open_file(source).read_all()
+        tagged = json.loads(table.schema.metadata.get(b"tagged", b"[]"))
+
+        return _untagged(nan_for_null(table.to_pandas(split_blocks=True)), tagged)
+
+    def _read_manifest(self, stage):
+        path = self._path(stage, self._manifest_name)
+
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as file:
+            return json.load(file)
+
+    def _write_frame(self, directory, key, frame):
+        """file format written, arrow unless the frame would not round trip"""
+        try:
+            if not all(isinstance(column, str) for column in frame.columns):
+                raise TypeError("column names must be str")
+
+            if not frame.columns.is_unique:
+                raise TypeError("column names must be unique")
+
+            table = _to_table(frame)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+            with open(os.path.join(directory, f"{key}.pkl"), "wb") as file:
+                pickle.dump(frame, file)
+
+            return "pickle"
+
+        feather.write_feather(
+            table, os.path.join(directory, f"{key}.arrow"), compression="uncompressed"
+        )
+        return "arrow"
+
+
+def _frames(output, key="output"):
+    """(key, frame) of every frame within output, keys usable as filenames"""
+    if isinstance(output, pd.DataFrame):
+        return [(key, output)]
+
+    if isinstance(output, (list, tuple)):
+        items = enumerate(output)
+    elif isinstance(output, dict):
+        items = output.items()
+    else:
+        return []
+
+    return [pair for name, item in items for pair in _frames(item, f"{key}.{name}")]
+
+
+def _as_text(column):
+    """whether arrow holds the values of an object column as text"""
+    try:
+        array = pa.array(column.to_numpy(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return False
+
+    return _is_text(array.type)
+
+
+def _from_layout(layout, frames):
+    kind = layout["kind"]
+
+    if kind == "frame":
+        return frames[layout["key"]]
+
+    if kind == "list":
+        return [_from_layout(item, frames) for item in layout["items"]]
+
+    if kind == "dict":
+        return {name: _from_layout(item, frames) for name, item in layout["items"]}
+
+    return layout["value"]
+
+
+def _is_text(arrow_type):
+    """str, bytes or nulls alone, read back as the python objects written"""
+    return (
+        pa.types.is_string(arrow_type)
+        or pa.types.is_binary(arrow_type)
+        or pa.types.is_null(arrow_type)
+    )
+
+
+def _layout(output, key="output"):
+    """structure of output as json, frames referred to by key"""
+    if isinstance(output, pd.DataFrame):
+        return {"kind": "frame", "key": key}
+
+    if isinstance(output, (list, tuple)):
+        items = [_layout(item, f"{key}.{name}") for name, item in enumerate(output)]
+        return {"kind": "list", "items": items}
+
+    if isinstance(output, dict):
+        items = [
+            [name, _layout(item, f"{key}.{name}")] for name, item in output.items()
+        ]
+        return {"kind": "dict", "items": items}
+
+    return {"kind": "value", "value": output}
+
+
+def _tag_name(column):
+    return f"{column}.__types__"
+
+
+def _tag_of(value):
+    """type of a value in an object column, bool tried before int, of which
+    it is a subclass
+    """
+    if value is None:
+        return "none"
+
+    for tag, types in _tag_types:
+        if isinstance(value, types):
+            return tag
+
+    raise TypeError(f"cannot tag a value of type {type(value).__name__}")
+
+
+def _tagged(column):
+    """str of each value, None kept, and the type tag of each"""
+    tags = column.map(_tag_of)
+    text = column.map(lambda value: None if value is None else str(value))
+
+    return text, pd.Categorical(tags)
+
+
+def _to_table(frame):
+    """arrow table of frame, object columns not held as text tagged, their
+    names listed in the schema metadata under b"tagged"
+    """
+    objects = frame.columns[frame.dtypes == "object"]
+
+    try:
+        table = pa.Table.from_pandas(frame)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        tagged = [column for column in objects if not _as_text(frame[column])]
+
+        if not tagged:
+            raise
+    else:
+        # data columns come first, any index columns after them
+        types = dict(zip(frame.columns, table.schema.types))
+        tagged = [column for column in objects if not _is_text(types[column])]
+
+        if not tagged:
+            return table
+
+    if any(_tag_name(column) in frame.columns for column in tagged):
+        raise TypeError("column names clash with type tags")
+
+    frame = frame.copy(deep=False)
+
+    for column in tagged:
+        frame[column], frame[_tag_name(column)] = _tagged(frame[column])
+
+    table = pa.Table.from_pandas(frame)
+    metadata = {**table.schema.metadata, b"tagged": json.dumps(tagged).encode()}
+
+    return table.replace_schema_metadata(metadata)
+
+
+def _untagged(frame, tagged):
+    """tagged columns restored to their values, type tags dropped"""
+    for column in tagged:
+        text = frame[column].to_numpy(dtype=object, copy=True)
+        tags = frame.pop(_tag_name(column)).to_numpy(dtype=object)
+
+        for tag, restore in _tag_restore.items():
+            within = tags == tag
+
+            if within.any():
+                text[within] = [restore(value) for value in text[within]]
+
+        frame[column] = text
+
+    return frame
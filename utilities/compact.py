@@ -0,0 +1,78 @@
+import pandas as pd
+import numpy as np
+
+
+def compact(frame):
+    """str columns as categoricals, measures downcast where no value changes
+
+    categories are sorted, so categorical sorts order rows as str sorts would
+    """
+    frame = frame.copy(deep=False)
+
+    for column in frame.columns:
+        frame[column] = compact_series(frame[column])
+
+    return frame
+
+
+def compact_series(series):
+    if series.dtype == "object":
+        if pd.api.types.infer_dtype(series, skipna=True) != "string":
+            return series
+        return series.astype("category")
+
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.to_numeric(series, downcast="integer")
+
+    if pd.api.types.is_float_dtype(series.dtype):
+        downcast = series.astype(np.float32)
+        lossless = (downcast == series) | series.isna()
+        return downcast if lossless.all() else series
+
+    return series
+
+
+def is_categorical(series):
+    return isinstance(series.dtype, pd.CategoricalDtype)
+
+
+def replace(series, to_replace, value=None):
+    """series.replace, a categorical staying categorical; a dict replaces
+    all at once, never chaining one replacement into the next
+    """
+    if not isinstance(to_replace, dict):
+        to_replace = {to_replace: value}
+
+    if not is_categorical(series):
+        return series.replace(to_replace)
+
+    return map_categories(series, lambda categories: categories.replace(to_replace))
+
+
+def upper(series):
+    """series.str.upper(), a categorical staying categorical"""
+    if not is_categorical(series):
+        return series.str.upper()
+
+    return map_categories(series, lambda categories: categories.str.upper())
+
+
+def map_categories(series, func):
+    """func applied once per category, categories it makes collide merged,
+    then sorted anew
+    """
+    categories = func(series.cat.categories.to_series()).to_numpy()
+    present = pd.notna(categories)
+
+    merged = np.sort(pd.unique(categories[present]))
+    remap = np.full(len(categories), -1)
+    remap[present] = merged.searchsorted(categories[present])
+
+    codes = series.cat.codes.to_numpy()
+    codes = np.where(codes >= 0, remap[codes], -1)
+
+    return pd.Series(
+        pd.Categorical.from_codes(codes, categories=merged),
+        index=series.index,
+        name=series.name,
+    )
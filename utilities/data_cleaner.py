@@ -1,4 +1,9 @@
+from utilities import compact, instrumentation
+from collections import defaultdict
 import pandas as pd
+import numpy as np
+import math
+import re
 
 
 class AnalysisCleaner:
@@ -6,16 +11,40 @@ class AnalysisCleaner:
     _fcis_funds = ["fcis asset allocation funds"]
     _name = "Fund_Name"
 
-    def __init__(self, analysis):
-        self._prepped_analysis = self._prepper(analysis)
+    def __init__(self, analysis, object_columns=None, prepped=False):
+        """object_columns, upper cased as if held as object, though not in
+        analysis, for analysis as one quarter of a longer history where
+        they are
+
+        prepped, analysis is already an AnalysisCleaner.analysis, one
+        read back from a checkpoint say, and is taken as is
+        """
+        if prepped:
+            self._prepped_analysis = analysis
+        else:
+            self._prepped_analysis = self._prepper(analysis, object_columns)
+
+        self._fund_name_index = None
+        self.unresolved_fund_names = None
+        self.fund_name_matches = None
 
     @property
     def analysis(self):
         return self._prepped_analysis
 
-    def update(self, analysis, cis_funds):
+    @instrumentation.instrument("update_analysis")
+    def update(self, analysis, cis_funds, fund_name_index=None, match_threshold=None):
         """a. analysis' fund names set to latest as per cis funds'
         b. fund and sector code mapped
+
+        fund_name_index, a FundNameIndex of cis_funds, is built and kept for
+        later calls if not given; names left without a fund code are
+        reported in unresolved_fund_names
+
+        match_threshold, names without an exact match are matched
+        approximately, see FundNameMatcher, those scoring at least
+        match_threshold resolved as their match and reported in
+        fund_name_matches
         """
         analysis = analysis.copy(deep=True)
 
@@ -23,41 +52,49 @@ class AnalysisCleaner:
         sector_code_mapped = analysis.Sector_Classification.map(sector_code)
         analysis.insert(5, "Sector_Code", sector_code_mapped)
 
-        fund_code = self._name_to_code(cis_funds["funds_operational"])
-        analysis.Fund_Name = self._update_fund_name(analysis.Fund_Name, cis_funds)
+        if fund_name_index is None:
+            fund_name_index = self._get_fund_name_index(cis_funds)
+
+        matches = None
 
-        fund_code_mapped = analysis.Fund_Name.map(fund_code)
+        if match_threshold is not None:
+            matches = fund_name_index.match_unresolved(
+                analysis.Fund_Name, match_threshold
+            )
+            self.fund_name_matches = matches
+
+        fund_name, fund_code_mapped = fund_name_index.resolve(
+            analysis.Fund_Name, matches
+        )
+        analysis.Fund_Name = fund_name
         analysis.insert(7, "Fund_Code", fund_code_mapped)
 
-        return analysis
+        self.unresolved_fund_names = fund_name_index.unresolved(
+            fund_name, fund_code_mapped
+        )
 
-    def _code_to_name(self, series):
-        col = series.columns[0]
-        key = series.columns[1]
-        return series.set_index(col).to_dict()[key]
+        return analysis
 
-    @staticmethod
-    def _map_fund_name(fund_names, mapping):
-        original_index = fund_names.index
-        fund_names = fund_names.reset_index(drop=True)
+    def _get_fund_name_index(self, cis_funds):
+        """reused for as long as update is given the same cis funds"""
+        index = self._fund_name_index
 
-        for index, name in enumerate(fund_names):
-            name = name.upper() if name is str else name
-            fund_names.iloc[index] = mapping.get(name, name)
+        if index is None or not index.built_from(cis_funds):
+            index = self._fund_name_index = FundNameIndex(cis_funds)
 
-        fund_names.index = original_index
-        return fund_names
+        return index
 
     def _name_to_code(self, series):
         col = series.columns[1]
         key = series.columns[0]
         return series.set_index(col).to_dict()[key]
 
-    def _prepper(self, analysis):
+    @instrumentation.instrument("clean_analysis")
+    def _prepper(self, analysis, object_columns=None):
         analysis_ = analysis.copy(deep=True)
         analysis_ = self._standardise_shorthand(analysis_)
         analysis_ = self._remove_fcis_funds(analysis_)
-        return self._uppercase_object_types(analysis_)
+        return self._uppercase_object_types(analysis_, object_columns)
 
     def _remove_fcis_funds(self, analysis):
         class_ = analysis.Sector_Classification
@@ -68,10 +105,11 @@ class AnalysisCleaner:
 
     def _standardise_shorthand(self, analysis):
         corrected_feat = {
-            "Fund_of_Funds": analysis.Fund_of_Funds.replace("NAN", "Not_FoF"),
-            "Third_Party": analysis.Third_Party.replace("NAN", "Not_TP"),
-            "Management_Style": analysis.Management_Style.replace(
-                {"tbc": "TBC", "NAN": "TBC"}
+            "Fund_of_Funds": compact.replace(analysis.Fund_of_Funds, "NAN", "Not_FoF"),
+            "Third_Party": compact.replace(analysis.Third_Party, "NAN", "Not_TP"),
+            "Management_Style": compact.replace(
+                analysis.Management_Style,
+                {"tbc": "TBC", "NAN": "TBC"},
             ),
         }
 
@@ -80,58 +118,324 @@ class AnalysisCleaner:
 
         return analysis
 
-    def _update_fund_name(self, fund_name, cis_funds):
-        old_names_to_code = self._name_to_code(cis_funds["funds_archived"])
-        fund_names_coded = fund_name.replace(old_names_to_code)
+    def _uppercase_object_types(self, analysis, object_columns=None):
+        """categoricals, from compact standardisation, included"""
+        object_columns = set() if object_columns is None else set(object_columns)
 
-        code_to_new_names = self._code_to_name(cis_funds["funds_operational"])
-        return fund_names_coded.replace(code_to_new_names)
+        features = [
+            feat
+            for feat, series in analysis.items()
+            if series.dtype == "object"
+            or compact.is_categorical(series)
+            or feat in object_columns
+        ]
 
-    def _uppercase_object_types(self, analysis):
-        objects = analysis.dtypes == "object"
-        features = [feat for feat, bool_ in objects.items() if bool_]
-        analysis[features] = analysis[features].apply(lambda series: series.str.upper())
+        for feat in features:
+            series = analysis[feat]
+
+            if series.dtype == "object" or compact.is_categorical(series):
+                analysis[feat] = compact.upper(series)
+            else:
+                # no str to upper, str.upper of a mixed column blanks the rest
+                analysis[feat] = pd.Series(np.nan, index=series.index, dtype=object)
 
         return analysis
 
 
+class FundNameIndex:
+    """fund name resolution built once from CISFundsCleaner.cis_funds:
+    archived name -> code -> operational name collapsed into one table,
+    operational name -> code into another, each applied in one pass
+    """
+
+    def __init__(self, cis_funds):
+        self._funds_archived = cis_funds["funds_archived"]
+        self._funds_operational = cis_funds["funds_operational"]
+
+        archived_to_code = self._lookup(self._funds_archived, "Fund_Name", "Fund_Code")
+        code_to_current = self._lookup(
+            self._funds_operational, "Fund_Code", "Fund_Name"
+        )
+
+        self.current_names = {
+            **code_to_current,
+            **{
+                name: code_to_current.get(code, code)
+                for name, code in archived_to_code.items()
+            },
+        }
+
+        self.codes = self._lookup(self._funds_operational, "Fund_Name", "Fund_Code")
+        self._matcher = None
+
+    def built_from(self, cis_funds):
+        return (
+            cis_funds["funds_archived"] is self._funds_archived
+            and cis_funds["funds_operational"] is self._funds_operational
+        )
+
+    def match_unresolved(self, fund_names, threshold=0.8):
+        """approximate matches, as FundNameMatcher.match, of the distinct
+        names resolve leaves without a code, each with its current name and
+        fund code
+
+        candidates are every operational name and every archived name with
+        a code, the matcher built on first use and kept
+        """
+        if self._matcher is None:
+            archived = [
+                name
+                for name in self._funds_archived.Fund_Name
+                if self._code(name) is not None
+            ]
+            self._matcher = FundNameMatcher(list(self.codes) + archived)
+
+        names = pd.Series(np.asarray(pd.unique(fund_names), dtype=object))
+        _, codes = self.resolve(names)
+
+        matches = self._matcher.match(names[codes.isna()], threshold)
+        current_names = self._current_name(matches.Match, self.current_names)
+        matches.insert(2, "Current_Name", current_names)
+        matches.insert(3, "Fund_Code", matches.Current_Name.map(self.codes))
+
+        return matches
+
+    def resolve(self, fund_names, matches=None):
+        """current fund names and their fund codes, categoricals resolved
+        once per category
+
+        matches, from match_unresolved, names matched resolved as their match
+        """
+        current_names = self.current_names
+
+        if matches is not None:
+            current_names = {
+                **current_names,
+                **dict(zip(matches.Fund_Name, matches.Current_Name)),
+            }
+
+        def current_name(names):
+            return self._current_name(names, current_names)
+
+        if compact.is_categorical(fund_names):
+            names = compact.map_categories(fund_names, current_name)
+        else:
+            names = current_name(fund_names)
+
+        return names, names.map(self.codes)
+
+    @staticmethod
+    def unresolved(fund_names, fund_codes):
+        """occurrences of each fund name left without a code, a missing name
+        among them
+        """
+        missing = fund_names[fund_codes.isna()].astype(object)
+        # None and NaN alike, one count of names missing
+        missing = missing.where(missing.notna())
+
+        return (
+            missing.value_counts(dropna=False)
+            .rename_axis("Fund_Name")
+            .rename("Occurrences")
+            .sort_index()
+            .reset_index()
+        )
+
+    def _code(self, fund_name):
+        return self.codes.get(self.current_names.get(fund_name, fund_name))
+
+    @staticmethod
+    def _current_name(fund_names, current_names):
+        current = fund_names.map(current_names)
+        return current.where(current.notna(), fund_names)
+
+    @staticmethod
+    def _lookup(funds, key, value):
+        """last row wins where a key repeats"""
+        return dict(zip(funds[key], funds[value]))
+
+
+class FundNameMatcher:
+    """approximate fund name matching, names taken as keys of their words
+    sorted, case and punctuation dropped, and scored by the dice
+    coefficient of the character trigrams of their keys
+
+    candidates are blocked by trigram: a name is compared only with those
+    sharing one of its rarest trigrams, as many of them as a dice of
+    threshold requires be shared, so no match at or above threshold is
+    missed while blocks stay small as the names grow in number
+    """
+
+    _ngram = 3
+
+    def __init__(self, fund_names):
+        """fund_names, candidates, the first name of each key kept"""
+        keys = {}
+
+        for name in fund_names:
+            key = self._key(name)
+
+            if key:
+                keys.setdefault(key, name)
+
+        self._names = list(keys.values())
+        self._grams = [self._ngrams(key) for key in keys]
+        self._blocks = defaultdict(list)
+
+        for candidate, grams in enumerate(self._grams):
+            for gram in grams:
+                self._blocks[gram].append(candidate)
+
+    def match(self, fund_names, threshold=0.8):
+        """best match of each distinct name scoring at least threshold,
+        Fund_Name, Match and Score, ties to the first candidate
+        """
+        rows = []
+
+        for name in dict.fromkeys(fund_names):
+            key = self._key(name)
+
+            if not key:
+                continue
+
+            best = self._best_match(self._ngrams(key), threshold)
+
+            if best is not None:
+                rows.append((name, *best))
+
+        return pd.DataFrame(data=rows, columns=["Fund_Name", "Match", "Score"])
+
+    def _best_match(self, grams, threshold):
+        """match and score, None if no candidate reaches threshold"""
+        # dice >= t requires an overlap of at least t * |grams| / (2 - t)
+        overlap = math.ceil(threshold * len(grams) / (2 - threshold) - 1e-9)
+        prefix = len(grams) - max(overlap, 1) + 1
+
+        rarest = sorted(grams, key=lambda gram: (len(self._blocks.get(gram, [])), gram))
+        candidates = sorted(
+            {
+                candidate
+                for gram in rarest[:prefix]
+                for candidate in self._blocks.get(gram, [])
+            }
+        )
+
+        best, best_score = None, 0.0
+
+        for candidate in candidates:
+            shared = len(grams & self._grams[candidate])
+            score = 2 * shared / (len(grams) + len(self._grams[candidate]))
+
+            if score > best_score:
+                best, best_score = candidate, score
+
+        if best is None or best_score < threshold:
+            return None
+
+        return self._names[best], round(best_score, 4)
+
+    @staticmethod
+    def _key(name):
+        if not isinstance(name, str):
+            return ""
+        return " ".join(sorted(re.findall(r"[A-Z0-9]+", name.upper())))
+
+    @classmethod
+    def _ngrams(cls, key):
+        padded = f" {key} "
+        return frozenset(
+            padded[start : start + cls._ngram]
+            for start in range(len(padded) - cls._ngram + 1)
+        )
+
+
 class CISFundsCleaner:
+    """each table computed on first access and kept until invalidated,
+    tables handed out are shared, not to be modified in place
+    """
+
     _feat = ["Fund_Code", "Fund_Name", "Sector_Code", "Sector_Classification"]
 
     def __init__(self, cis_funds):
-        funds = cis_funds[self._feat].astype(str)
-        self._prepped_funds = funds.apply(lambda series: series.str.upper())
-        # is the str.upper still necessary?
+        self._prepped_funds = self._prepper(cis_funds)
+        self._tables = {}
 
     @property
     def cis_funds(self):
         return {
-            "funds_operational": self._clean_fund_names_by_usage("operational"),
-            "funds_archived": self._clean_fund_names_by_usage("archived"),
-            "sectors": self._clean_sector_class(),
+            "funds_operational": self.funds_operational,
+            "funds_archived": self.funds_archived,
+            "sectors": self.sectors,
         }
 
-    def _clean_fund_names_by_usage(self, state):
-        funds = self._prepped_funds.copy(deep=True).reset_index()
-        funds = funds[self._feat[:2]]
+    @property
+    def funds_archived(self):
+        return self._fund_names_by_usage()["archived"]
+
+    @property
+    def funds_operational(self):
+        return self._fund_names_by_usage()["operational"]
+
+    @property
+    def sectors(self):
+        if "sectors" not in self._tables:
+            self._tables["sectors"] = self._clean_sector_class()
+        return self._tables["sectors"]
+
+    def add(self, cis_funds):
+        """new quarters of standardised cis funds, put ahead of those held,
+        as the latest quarters lead in a full run
+        """
+        self._prepped_funds = pd.concat([self._prepper(cis_funds), self._prepped_funds])
+        self.invalidate()
+
+    def invalidate(self):
+        self._tables.clear()
+
+    @staticmethod
+    def _as_str(series):
+        """categoricals, from compact standardisation, already hold str"""
+        if compact.is_categorical(series):
+            return series
+        return series.astype(str)
+
+    @instrumentation.instrument("clean_fund_names_by_usage")
+    def _clean_fund_names_by_usage(self):
+        """operational and archived split from one drop_duplicates of codes,
+        first use of a code operational, any other use archived
+        """
+        funds = self._prepped_funds[self._feat[:2]].reset_index(drop=True)
 
         unique = funds["Fund_Code"].drop_duplicates()
 
-        funds = {
+        funds_by_usage = {
             "operational": funds.loc[unique.index],
             "archived": funds.drop(index=unique.index),
-        }[state]
+        }
+
+        for state, funds in funds_by_usage.items():
+            funds = funds.drop_duplicates()
+            funds = funds.sort_values(by="Fund_Name")
 
-        funds = funds.drop_duplicates()
-        funds = funds.sort_values(by="Fund_Name")
+            funds.index = range(1, funds.shape[0] + 1)
+            funds_by_usage[state] = funds
 
-        funds.index = range(1, funds.shape[0] + 1)
-        return funds
+        return funds_by_usage
 
     def _clean_sector_class(self):
         """unique sector codes, ignores if not four chars long"""
         modal_len = 4
-        funds = self._prepped_funds.copy(deep=True)
-        funds = funds[self._feat[2:]].drop_duplicates()
+        funds = self._prepped_funds[self._feat[2:]].drop_duplicates()
         mask = funds["Sector_Code"].str.len() == modal_len
         return funds[mask].sort_values(by="Sector_Classification", ignore_index=True)
+
+    def _fund_names_by_usage(self):
+        if "funds" not in self._tables:
+            self._tables["funds"] = self._clean_fund_names_by_usage()
+        return self._tables["funds"]
+
+    @instrumentation.instrument("clean_cis_funds")
+    def _prepper(self, cis_funds):
+        funds = cis_funds[self._feat].apply(self._as_str)
+        # is the str.upper still necessary?
+        return funds.apply(compact.upper)
@@ -1,18 +1,28 @@
-from matplotlib.patches import FancyBboxPatch
-import matplotlib.pyplot as plt
-import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import numpy as np
+import os
 
 
 class FlowDataExplorer:
+    """matplotlib and seaborn are imported only once a plot is asked for"""
+
+    _figure_titles = {
+        "number_of_quarters": "Quarters in Each Data Set",
+        "value_counts": "Unique Entries in Each Data Set",
+    }
+
     def __init__(self, analyses, cis_funds):
         self._analyses = analyses.copy(deep=True)
         self._cis_funds = cis_funds.copy(deep=True)
 
+        self._fund_codes = _ValueIndex(self._cis_funds.Fund_Code)
+        self._sector_codes = _ValueIndex(self._cis_funds.Sector_Code)
+        self._sector_classes = _ValueIndex(self._cis_funds.Sector_Classification)
+
     def cis_funds_matching_sub_code(self, fund_code):
-        codes = self._cis_funds.Fund_Code.astype(str)
-        mask = codes.apply(lambda str_: str_ in fund_code)
-        return self._cis_funds[mask]
+        rows = self._fund_codes.rows_within(fund_code)
+        return self._cis_funds.iloc[rows]
 
     def inconsistent_fund_code_dtype(self):
         codes = self._cis_funds.Fund_Code
@@ -20,13 +30,10 @@ class FlowDataExplorer:
         return self._cis_funds[mask]
 
     def inconsistent_sector_code_class_mapping(self, code, class_):
-        codes = self._cis_funds.Sector_Code
-        mask_1 = codes.astype(str).str.contains(code)
+        rows_1 = self._sector_codes.rows_containing(code)
+        rows_2 = self._sector_classes.rows_containing(class_)
 
-        classes = self._cis_funds.Sector_Classification
-        mask_2 = classes.astype(str).str.contains(class_)
-
-        return self._cis_funds[mask_1 | mask_2]
+        return self._cis_funds.iloc[np.union1d(rows_1, rows_2)]
 
     def inconsistent_fund_code_multi_mapping(self, feature):
         funds = self._cis_funds[["Fund_Code", "Fund_Name"]].astype(str)
@@ -47,12 +54,10 @@ class FlowDataExplorer:
         return self._cis_funds[mask]
 
     def inconsistent_sector_code_usage(self, code_1, code_2):
-        codes = self._cis_funds.Sector_Code
+        rows_1 = self._sector_codes.rows_containing(code_1)
+        rows_2 = self._sector_codes.rows_containing(code_2)
 
-        mask_1 = codes.astype(str).str.contains(code_1)
-        mask_2 = codes.astype(str).str.contains(code_2)
-
-        inconsistencies = self._cis_funds[mask_1 | mask_2]
+        inconsistencies = self._cis_funds.iloc[np.union1d(rows_1, rows_2)]
 
         sectors = inconsistencies[["Sector_Code", "Sector_Classification"]]
 
@@ -75,21 +80,34 @@ class FlowDataExplorer:
             index=["No. of Quarters"],
         )
 
-    def plot_number_of_quarters(self):
-        data = self.number_of_quarters
-        return self._generate_barplot(
-            data=data,
-            title="Quarters in Each Data Set",
-            xlabel=data.index[0],
-        )
+    def plot_number_of_quarters(self, path=None):
+        """shown, or written to path, format by extension, if given"""
+        return self._generate_barplot(*self._get_figure("number_of_quarters"), path)
 
-    def plot_value_counts(self):
-        data = self.value_counts
-        return self._generate_barplot(
-            data=data,
-            title="Unique Entries in Each Data Set",
-            xlabel=data.index[0],
-        )
+    def plot_value_counts(self, path=None):
+        """shown, or written to path, format by extension, if given"""
+        return self._generate_barplot(*self._get_figure("value_counts"), path)
+
+    def render(self, directory, formats=("png",), workers=1):
+        """every figure written to directory once per format, headless,
+        workers figures at a time in separate processes; paths returned
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        jobs = [
+            (
+                *self._get_figure(name),
+                os.path.join(directory, f"{name}.{format_}"),
+            )
+            for name in self._figure_titles
+            for format_ in formats
+        ]
+
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                return list(executor.map(_render_barplot, jobs))
+
+        return [_render_barplot(job) for job in jobs]
 
     def sample_of_analysis(self, date_key):
         return self._analyses.loc[date_key].iloc[:5, :8]
@@ -116,53 +134,127 @@ class FlowDataExplorer:
         )
 
     @staticmethod
-    def _generate_barplot(data, title, xlabel):
+    def _generate_barplot(data, title, xlabel, path=None):
+        """shown through pyplot, or, with path, drawn on a figure of its own
+        and saved, never touching pyplot, so that it runs headless
+        """
+        from matplotlib.patches import FancyBboxPatch
+        from matplotlib.figure import Figure
+        import seaborn as sns
+        import matplotlib
+
         BOLD = "bold"
-        sns.set(
-            rc={
-                "axes.labelpad": 25,
-                "axes.titlesize": 24,
-                "figure.figsize": (10, 4),
-                "font.weight": BOLD,
-                "ytick.major.pad": 25,
-            },
-            style="white",
-        )
+        rc = {
+            "axes.labelpad": 25,
+            "axes.titlesize": 24,
+            "figure.figsize": (10, 4),
+            "font.weight": BOLD,
+            "ytick.major.pad": 25,
+        }
+
+        # as sns.set applied them: context, style and palette, then rc
+        theme = {
+            **sns.plotting_context("notebook"),
+            **sns.axes_style("white"),
+            "axes.prop_cycle": matplotlib.cycler(color=sns.color_palette("deep")),
+            **rc,
+        }
+
+        with matplotlib.rc_context(theme):
+            if path is None:
+                import matplotlib.pyplot as plt
+
+                figure = plt.figure()
+            else:
+                figure = Figure()
+
+            plot = sns.barplot(
+                data=data,
+                orient="h",
+                palette="Blues",
+                ax=figure.subplots(),
+            )
 
-        plot = sns.barplot(
-            data=data,
-            orient="h",
-            palette="Blues",
-        )
+            patches = []
 
-        patches = []
+            for patch in reversed(plot.patches):
+                bb = patch.get_bbox()
+                color = patch.get_facecolor()
 
-        for patch in reversed(plot.patches):
-            bb = patch.get_bbox()
-            color = patch.get_facecolor()
+                p_bbox = FancyBboxPatch(
+                    xy=(bb.xmin, bb.ymin),
+                    width=abs(bb.width),
+                    height=abs(bb.height),
+                    boxstyle=f"round, pad=-0.25, rounding_size=2",
+                    ec="none",
+                    fc=color,
+                    mutation_aspect=0.2,
+                )
 
-            p_bbox = FancyBboxPatch(
-                xy=(bb.xmin, bb.ymin),
-                width=abs(bb.width),
-                height=abs(bb.height),
-                boxstyle=f"round, pad=-0.25, rounding_size=2",
-                ec="none",
-                fc=color,
-                mutation_aspect=0.2,
-            )
+                patch.remove()
+                patches.append(p_bbox)
+
+            for patch in patches:
+                plot.add_patch(patch)
+
+            sns.despine(ax=plot, left=True, bottom=True)
+
+            plot.bar_label(plot.containers[0])
+            plot.set_title(title, weight=BOLD)
+            plot.set_xlabel(xlabel, fontsize=16, weight=BOLD)
+            plot.set_yticklabels(data.columns)
+
+            figure.tight_layout()
+
+            if path is None:
+                plt.show()
+                return
+
+            figure.savefig(path)
+            return path
+
+    def _get_figure(self, name):
+        data = getattr(self, name)
+        return data, self._figure_titles[name], data.index[0]
+
+
+class _ValueIndex:
+    """distinct values of a column, as str, each with the rows holding it,
+    so lookups test every distinct value once and gather rows by position
+    """
+
+    def __init__(self, values):
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object).astype(str))
+
+        self._uniques = pd.Index(uniques)
+        self._order = np.argsort(codes, kind="stable")
+        self._ends = np.cumsum(np.bincount(codes, minlength=len(uniques)))
+        self._starts = self._ends - np.bincount(codes, minlength=len(uniques))
+
+    def rows_containing(self, pattern):
+        """rows whose value matches regex pattern, as str.contains"""
+        matches = np.asarray(self._uniques.str.contains(pattern), dtype=bool)
+        return self._rows(np.flatnonzero(matches))
 
-            patch.remove()
-            patches.append(p_bbox)
+    def rows_within(self, string):
+        """rows whose value is a substring of string, a hash lookup per
+        substring of string
+        """
+        substrings = {
+            string[start:end]
+            for start in range(len(string) + 1)
+            for end in range(start, len(string) + 1)
+        }
 
-        for patch in patches:
-            plot.add_patch(patch)
+        positions = self._uniques.get_indexer(list(substrings))
+        return self._rows(positions[positions >= 0])
 
-        sns.despine(left=True, bottom=True)
+    def _rows(self, positions):
+        """row positions, in row order, of the distinct values at positions"""
+        rows = [self._order[self._starts[pos] : self._ends[pos]] for pos in positions]
+        return np.sort(np.concatenate(rows)) if rows else np.array([], dtype=int)
 
-        plot.bar_label(plot.containers[0])
-        plot.set_title(title, weight=BOLD)
-        plot.set_xlabel(xlabel, fontsize=16, weight=BOLD)
-        plot.set_yticklabels(data.columns)
 
-        plt.tight_layout()
-        plt.show()
+def _render_barplot(job):
+    """job as data, title, xlabel and path, for worker processes"""
+    return FlowDataExplorer._generate_barplot(*job)
@@ -0,0 +1,205 @@
+from utilities.logger import LOG_DIR
+import pandas as pd
+import numpy as np
+import hashlib
+import pickle
+import json
+import os
+
+
+class FlowDataProfiler:
+    """FlowDataExplorer's CISFunds checks in one report
+
+    each quarter is scanned once, down to its distinct fund code and name
+    pairs and sector code and classification pairs with row counts; the
+    report is drawn from those alone, and a quarter is only scanned again
+    if its rows change. scans are kept in memory and under cache_dir if
+    given
+    """
+
+    _date_key = "Date_Key"
+    _fund_pair = ["Fund_Code", "Fund_Name"]
+    _sector_pair = ["Sector_Code", "Sector_Classification"]
+    _modal_sector_code_len = 4
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.scanned_quarters = []
+        self._scans = {}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def profile(self, cis_funds):
+        """report as a dict of plain python values, ready for json"""
+        fund_pairs, sector_pairs = self._get_scans(cis_funds)
+
+        return {
+            "quarters": [int(date) for date in cis_funds.index.unique()],
+            "rows": int(cis_funds.shape[0]),
+            "fund_code_dtype": self._fund_code_dtype(fund_pairs),
+            "sector_code_format": self._sector_code_format(sector_pairs),
+            "fund_code_multi_mapping": {
+                feature: self._multi_mapping(fund_pairs, self._fund_pair, feature)
+                for feature in self._fund_pair
+            },
+            "sector_code_multi_mapping": {
+                feature: self._multi_mapping(sector_pairs, self._sector_pair, feature)
+                for feature in self._sector_pair
+            },
+        }
+
+    def to_json(self, cis_funds, filename="data_quality"):
+        """report written next to the logs, path returned"""
+        if not os.path.isdir(LOG_DIR):
+            os.mkdir(LOG_DIR)
+
+        path = f"{LOG_DIR}{filename}.json"
+
+        with open(path, "w") as file:
+            json.dump(self.profile(cis_funds), file, indent=2)
+
+        return path
+
+    @staticmethod
+    def _as_str(series):
+        """from a copy, astype(str) can rewrite mixed object columns in place"""
+        return pd.Series(np.asarray(series, dtype=object).astype(str))
+
+    @classmethod
+    def _fund_code_dtype(cls, fund_pairs):
+        """fund codes made of digits only, rows per quarter"""
+        codes = fund_pairs.groupby([cls._date_key, "Fund_Code"]).Rows.sum()
+        codes = codes.reset_index()
+
+        is_digit = codes.Fund_Code.str.isdigit().to_numpy(dtype=bool)
+        return cls._records(codes[is_digit])
+
+    def _get_scans(self, cis_funds):
+        """scans of every quarter, those of new or changed quarters made in
+        one pass over their rows together
+        """
+        quarters = cis_funds.groupby(level=0, sort=False).indices
+        hashes = self._hash_quarters(cis_funds, quarters)
+
+        scans = {}
+        rescan = []
+
+        for date, quarter_hash in hashes.items():
+            scan = self._load_scan(date, quarter_hash)
+
+            if scan is None:
+                rescan.append(date)
+            else:
+                scans[date] = scan
+
+        if rescan:
+            rows = np.concatenate([quarters[date] for date in rescan])
+            fund_pairs, sector_pairs = self._scan(cis_funds.iloc[rows])
+
+            fund_pairs = dict(list(fund_pairs.groupby(self._date_key)))
+            sector_pairs = dict(list(sector_pairs.groupby(self._date_key)))
+
+            for date in rescan:
+                scans[date] = (fund_pairs[date], sector_pairs[date])
+                self._store_scan(date, hashes[date], scans[date])
+
+        self.scanned_quarters = rescan
+
+        return [
+            pd.concat([scans[date][part] for date in hashes], ignore_index=True)
+            for part in (0, 1)
+        ]
+
+    @staticmethod
+    def _hash_quarters(cis_funds, quarters):
+        row_hashes = pd.util.hash_pandas_object(cis_funds, index=False).to_numpy()
+
+        return {
+            date: hashlib.sha256(row_hashes[rows].tobytes()).hexdigest()[:16]
+            for date, rows in quarters.items()
+        }
+
+    def _load_scan(self, date, quarter_hash):
+        key = (date, quarter_hash)
+
+        if key not in self._scans and self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, f"{date}-{quarter_hash}.pkl")
+
+            if os.path.isfile(path):
+                with open(path, "rb") as file:
+                    self._scans[key] = pickle.load(file)
+
+        return self._scans.get(key, None)
+
+    @classmethod
+    def _multi_mapping(cls, pairs, columns, feature):
+        """pairs whose feature value is paired with more than one value,
+        across all quarters, occurrences as rows
+        """
+        distinct = pairs.groupby(columns).Rows.sum().reset_index()
+        multi_use = distinct[feature].duplicated(keep=False)
+
+        distinct = distinct[multi_use].sort_values(by=columns, ignore_index=True)
+        return cls._records(distinct.rename(columns={"Rows": "Occurrences"}))
+
+    @staticmethod
+    def _records(frame):
+        return json.loads(frame.to_json(orient="records"))
+
+    @classmethod
+    def _scan(cls, cis_funds):
+        """every check's columns normalised once, then counted by distinct
+        pair; fund codes and names as str and upper case, sector codes and
+        classifications as str, a sector code's format judged on its raw
+        value
+        """
+        sector_code = cls._as_str(cis_funds.Sector_Code)
+
+        is_str = cis_funds.Sector_Code.apply(isinstance, args=(str,)).to_numpy()
+        is_modal = sector_code.str.len() == cls._modal_sector_code_len
+
+        columns = pd.DataFrame(
+            {
+                cls._date_key: cis_funds.index.to_numpy(),
+                "Fund_Code": cls._as_str(cis_funds.Fund_Code).str.upper(),
+                "Fund_Name": cls._as_str(cis_funds.Fund_Name).str.upper(),
+                "Sector_Code": sector_code,
+                "Sector_Classification": cls._as_str(cis_funds.Sector_Classification),
+                "Format_Ok": is_str & is_modal.to_numpy(),
+            }
+        )
+
+        fund_pairs = columns.groupby(
+            [cls._date_key, "Fund_Code", "Fund_Name"], sort=False
+        ).size()
+
+        sector_pairs = columns.groupby(
+            [cls._date_key, "Sector_Code", "Sector_Classification", "Format_Ok"],
+            sort=False,
+        ).size()
+
+        return (
+            fund_pairs.rename("Rows").reset_index(),
+            sector_pairs.rename("Rows").reset_index(),
+        )
+
+    @classmethod
+    def _sector_code_format(cls, sector_pairs):
+        """sector codes not of the modal length, rows per quarter"""
+        wrong = sector_pairs[~sector_pairs.Format_Ok]
+        codes = wrong.groupby([cls._date_key, "Sector_Code"]).Rows.sum()
+        return cls._records(codes.reset_index())
+
+    def _store_scan(self, date, quarter_hash, scan):
+        self._scans[(date, quarter_hash)] = scan
+
+        if self.cache_dir is None:
+            return
+
+        path = os.path.join(self.cache_dir, f"{date}-{quarter_hash}.pkl")
+
+        with open(f"{path}.part", "wb") as file:
+            pickle.dump(scan, file)
+
+        os.replace(f"{path}.part", path)
@@ -0,0 +1,176 @@
+import threading
+import tempfile
+import hashlib
+import json
+import time
+import os
+
+
+class WorkbookCache:
+    """content-addressed store of downloaded documents
+
+    layout:
+    <cache_dir>/index.json, url -> digest, validators, size, last access
+    <cache_dir>/objects/<sha256>, one file per distinct body
+    """
+
+    _chunk_size = 1024 * 1024
+    _index_name = "index.json"
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._objects_dir = os.path.join(cache_dir, "objects")
+        self._index_path = os.path.join(cache_dir, self._index_name)
+
+        os.makedirs(self._objects_dir, exist_ok=True)
+        self._index = self._read_index()
+
+    def __contains__(self, url):
+        return url in self._index
+
+    @property
+    def size(self):
+        """bytes on disk, a body shared by several urls counted once"""
+        digests = {entry["digest"]: entry["size"] for entry in self._index.values()}
+        return sum(digests.values())
+
+    def evict(self, keep=()):
+        """least recently used urls dropped until within max_bytes, urls in
+        keep never dropped, a page every later run starts from say
+        """
+        if self.max_bytes is None:
+            return []
+
+        with self._lock:
+            by_access = sorted(
+                (url for url in self._index if url not in keep),
+                key=lambda url: self._index[url]["accessed"],
+            )
+            evicted = []
+
+            for url in by_access:
+                if self.size <= self.max_bytes:
+                    break
+                del self._index[url]
+                evicted.append(url)
+
+            self._remove_orphaned_objects()
+            self._write_index()
+
+        return evicted
+
+    def get(self, session, url, offline=False, revalidate=True):
+        """path to the cached body of url
+
+        online, a cached url is revalidated with a conditional request and
+        only downloaded again if the server reports a change
+        """
+        entry = self._index.get(url)
+
+        if offline or (entry is not None and not revalidate):
+            if entry is None:
+                raise LookupError(f"not cached: {url}")
+            return self._hit(url)
+
+        headers = self._conditional_headers(entry)
+
+        with session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 304 and entry is not None:
+                return self._hit(url)
+
+            response.raise_for_status()
+            return self._store(url, response)
+
+    def invalidate(self, url=None):
+        """drop url, or everything if no url given"""
+        with self._lock:
+            if url is None:
+                self._index.clear()
+            else:
+                self._index.pop(url, None)
+
+            self._remove_orphaned_objects()
+            self._write_index()
+
+    def path(self, url):
+        return self._object_path(self._index[url]["digest"])
+
+    @staticmethod
+    def _conditional_headers(entry):
+        if entry is None:
+            return {}
+
+        validators = {
+            "If-None-Match": entry.get("etag"),
+            "If-Modified-Since": entry.get("last_modified"),
+        }
+
+        return {header: value for header, value in validators.items() if value}
+
+    def _hit(self, url):
+        with self._lock:
+            self._index[url]["accessed"] = time.time()
+            self._write_index()
+
+        return self.path(url)
+
+    def _object_path(self, digest):
+        return os.path.join(self._objects_dir, digest)
+
+    def _read_index(self):
+        if not os.path.isfile(self._index_path):
+            return {}
+
+        with open(self._index_path) as file:
+            return json.load(file)
+
+    def _remove_orphaned_objects(self):
+        referenced = {entry["digest"] for entry in self._index.values()}
+
+        for digest in os.listdir(self._objects_dir):
+            if digest not in referenced:
+                os.remove(self._object_path(digest))
+
+    def _store(self, url, response):
+        """body hashed while streamed to a temporary file, then moved into
+        place under its digest
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False) as file:
+            try:
+                for chunk in response.iter_content(chunk_size=self._chunk_size):
+                    sha256.update(chunk)
+                    size += len(chunk)
+                    file.write(chunk)
+            except BaseException:
+                file.close()
+                os.remove(file.name)
+                raise
+
+        digest = sha256.hexdigest()
+        os.replace(file.name, self._object_path(digest))
+
+        with self._lock:
+            self._index[url] = {
+                "digest": digest,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "size": size,
+                "accessed": time.time(),
+            }
+            self._write_index()
+
+        return self._object_path(digest)
+
+    def _write_index(self):
+        partial = f"{self._index_path}.part"
+
+        with open(partial, "w") as file:
+            json.dump(self._index, file, indent=1)
+
+        os.replace(partial, self._index_path)
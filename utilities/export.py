@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from utilities.sheet_cache import arrow_compatible
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import openpyxl
+import time
+import os
+
+
+class ExcelExport:
+    """one workbook, a sheet per table
+
+    streaming appends rows through a write-only workbook, a chunk of rows
+    in memory at a time; otherwise pandas writes through openpyxl as
+    to_excel always has. sheets of one workbook are written in turn
+    """
+
+    _chunk_size = 10000
+
+    def __init__(self, path, streaming=True):
+        self.path = path
+        self.streaming = streaming
+
+    def write(self, tables, workers=1):
+        if not self.streaming:
+            with pd.ExcelWriter(self.path, engine="openpyxl") as writer:
+                return _timed(tables, lambda name, frame: frame.to_excel(writer, name))
+
+        workbook = openpyxl.Workbook(write_only=True)
+        timings = _timed(
+            tables, lambda name, frame: self._append_sheet(workbook, name, frame)
+        )
+        workbook.save(self.path)
+
+        return timings
+
+    @classmethod
+    def _append_sheet(cls, workbook, sheet_name, frame):
+        sheet = workbook.create_sheet(sheet_name)
+
+        index_names = ["" if name is None else name for name in frame.index.names]
+        sheet.append([str(column) for column in index_names + list(frame.columns)])
+
+        frame = frame.reset_index()
+
+        for start in range(0, frame.shape[0], cls._chunk_size):
+            chunk = frame.iloc[start : start + cls._chunk_size].astype(object)
+            chunk = chunk.where(chunk.notna(), None)
+
+            for row in chunk.itertuples(index=False, name=None):
+                sheet.append(row)
+
+
+class ParquetExport:
+    """a parquet file per table under directory, tables in partition_by
+    written as datasets partitioned by the given column, by default the
+    fact by Date_Key
+    """
+
+    def __init__(self, directory, partition_by=None):
+        self.directory = directory
+        self.partition_by = (
+            {"Fact_Assets": "Date_Key"} if partition_by is None else partition_by
+        )
+
+    def write(self, tables, workers=1):
+        os.makedirs(self.directory, exist_ok=True)
+        return _timed(tables, self._write_table, workers)
+
+    def _write_table(self, name, frame):
+        partition_column = self.partition_by.get(name, None)
+
+        if partition_column is None:
+            table = pa.Table.from_pandas(arrow_compatible(frame))
+            pq.write_table(table, os.path.join(self.directory, f"{name}.parquet"))
+            return
+
+        frame = arrow_compatible(frame.reset_index())
+        pq.write_to_dataset(
+            pa.Table.from_pandas(frame, preserve_index=False),
+            root_path=os.path.join(self.directory, name),
+            partition_cols=[partition_column],
+            existing_data_behavior="delete_matching",
+        )
+
+
+class CSVExport:
+    """a csv file per table under directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def write(self, tables, workers=1):
+        os.makedirs(self.directory, exist_ok=True)
+        return _timed(tables, self._write_table, workers)
+
+    def _write_table(self, name, frame):
+        frame.to_csv(os.path.join(self.directory, f"{name}.csv"))
+
+
+def _timed(tables, write_table, workers=1):
+    """write_table(name, frame) per table, workers at a time, seconds and
+    rows of each table in a frame indexed by table name
+    """
+
+    def timed_write(table):
+        name, frame = table
+        start = time.perf_counter()
+        write_table(name, frame)
+        return name, frame.shape[0], time.perf_counter() - start
+
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            timings = list(executor.map(timed_write, tables))
+    else:
+        timings = [timed_write(table) for table in tables]
+
+    return pd.DataFrame(
+        data=timings,
+        columns=["Table", "Rows", "Seconds"],
+    ).set_index("Table")
@@ -0,0 +1,322 @@
+from contextlib import contextmanager
+from datetime import datetime
+import pandas as pd
+import tracemalloc
+import threading
+import functools
+import cProfile
+import resource
+import json
+import time
+import os
+
+
+_config = None
+_lock = threading.Lock()
+_local = threading.local()
+
+_open_stages = {}
+_sampler = None
+_sampler_stop = threading.Event()
+_traced_threads = set()
+
+
+def enable(
+    path, trace_memory=False, profile_dir=None, profile=None, sample_interval=0.01
+):
+    """stages append a json line each to path until disable is called
+
+    rss of the process is sampled every sample_interval seconds while any
+    stage is open, each stage recording the peak seen while it ran and its
+    growth over the rss at its start; stages run side by side share the
+    one process and so see each other's memory
+
+    trace_memory adds the peak python allocation within each stage over
+    that at its start, as traced by tracemalloc, which slows everything
+    traced down noticeably. tracemalloc keeps one peak per process, so
+    traced stages must run one at a time, a stage started while another
+    thread is within a traced stage raises RuntimeError
+
+    profile_dir keeps a cProfile dump of every stage named in profile, or
+    of every stage if profile is None, one profiler at a time per thread
+
+    pool workers forked while enabled report to the same file, each with
+    the locks and open stages of the parent dropped and a sampler of its own
+    """
+    global _config
+
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    _config = {
+        "path": path,
+        "trace_memory": trace_memory,
+        "profile_dir": profile_dir,
+        "profile": None if profile is None else set(profile),
+        "sample_interval": sample_interval,
+    }
+
+    _start_sampler(sample_interval)
+
+
+def count_rows(output):
+    """rows of a frame, or of the frames within a tuple, list or dict"""
+    if isinstance(output, (pd.DataFrame, pd.Series)):
+        return output.shape[0]
+
+    if isinstance(output, dict):
+        output = list(output.values())
+
+    if isinstance(output, (tuple, list)):
+        rows = [count_rows(item) for item in output]
+        rows = [row for row in rows if row is not None]
+        return sum(rows) if rows else None
+
+    return None
+
+
+def disable():
+    global _config, _sampler
+
+    if _config is not None and _config["trace_memory"]:
+        tracemalloc.stop()
+
+    _config = None
+
+    if _sampler is not None:
+        _sampler_stop.set()
+        _sampler.join()
+        _sampler = None
+
+
+def is_enabled():
+    return _config is not None
+
+
+def is_tracing_memory():
+    """stages must then run one at a time, see enable"""
+    return _config is not None and _config["trace_memory"]
+
+
+def instrument(name):
+    """decorator, func run as a stage, rows in counted from the first
+    frame among its arguments and rows out from what it returns
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _config is None:
+                return func(*args, **kwargs)
+
+            frames = [
+                arg
+                for arg in args + tuple(kwargs.values())
+                if count_rows(arg) is not None
+            ]
+            rows_in = count_rows(frames[0]) if frames else None
+
+            with stage(name, rows_in=rows_in) as record:
+                output = func(*args, **kwargs)
+                record["rows_out"] = count_rows(output)
+
+            return output
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def stage(name, rows_in=None, **fields):
+    """record of the stage yielded, to set rows_out or other fields on,
+    and written once the stage ends; while disabled a dict never written
+    """
+    if _config is None:
+        yield {}
+        return
+
+    record = {"stage": name, "rows_in": rows_in, "rows_out": None, **fields}
+    config = _config
+
+    # a forked worker starts without the sampler of its parent
+    _start_sampler(config["sample_interval"])
+
+    traced = _start_trace(config)
+    profiler = _start_profiler(name, config)
+
+    rss_start = _current_rss_bytes()
+    key = object()
+
+    with _lock:
+        _open_stages[key] = rss_start
+
+    start = datetime.now()
+    start_counter = time.perf_counter()
+
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.perf_counter() - start_counter, 6)
+        record["start"] = start.isoformat(timespec="milliseconds")
+        record["pid"] = os.getpid()
+        record["thread"] = threading.current_thread().name
+        rss_end = _current_rss_bytes()
+
+        with _lock:
+            rss_peak = max(_open_stages.pop(key), rss_end)
+
+        record["peak_rss_mb"] = round(rss_peak / 2**20, 2)
+        record["rss_growth_mb"] = round((rss_peak - rss_start) / 2**20, 2)
+
+        if traced is not None:
+            record["peak_traced_mb"] = round(_stop_trace(traced) / 2**20, 2)
+
+        if profiler is not None:
+            _stop_profiler(profiler, name, config)
+
+        _write(record, config)
+
+
+def _current_rss_bytes():
+    """resident set size now, from /proc where there is one, else the peak"""
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return _peak_rss_bytes()
+
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _peak_rss_bytes():
+    """ru_maxrss is reported in kilobytes on linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _start_profiler(name, config):
+    if config["profile_dir"] is None or getattr(_local, "profiling", False):
+        return None
+
+    if config["profile"] is not None and name not in config["profile"]:
+        return None
+
+    _local.profiling = True
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def _reset_after_fork():
+    """the child has only the thread that forked, so any lock held by
+    another thread, the sampler's among them, would never be released
+    """
+    global _lock, _local, _sampler, _sampler_stop
+
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    _open_stages.clear()
+    _traced_threads.clear()
+
+    _sampler = None
+    _sampler_stop = threading.Event()
+
+
+def _sample_rss(interval):
+    while not _sampler_stop.wait(interval):
+        rss = _current_rss_bytes()
+
+        with _lock:
+            for key, peak in _open_stages.items():
+                _open_stages[key] = max(peak, rss)
+
+
+def _start_sampler(interval):
+    global _sampler
+
+    with _lock:
+        if _sampler is not None:
+            return
+
+        _sampler_stop.clear()
+        _sampler = threading.Thread(
+            target=_sample_rss,
+            args=(interval,),
+            name="instrumentation-rss",
+            daemon=True,
+        )
+        _sampler.start()
+
+
+def _start_trace(config):
+    """peaks of enclosing stages kept on a per thread stack, tracemalloc
+    having the one peak, reset by each stage; a thread at a time
+    """
+    if not config["trace_memory"] or not tracemalloc.is_tracing():
+        return None
+
+    thread = threading.get_ident()
+
+    with _lock:
+        if _traced_threads - {thread}:
+            raise RuntimeError(
+                "trace_memory needs stages run one at a time, another thread "
+                "is within a traced stage"
+            )
+
+        _traced_threads.add(thread)
+
+    stack = getattr(_local, "peaks", None)
+
+    if stack is None:
+        stack = _local.peaks = []
+
+    current, peak = tracemalloc.get_traced_memory()
+
+    if stack:
+        stack[-1] = max(stack[-1], peak)
+
+    tracemalloc.reset_peak()
+    stack.append(current)
+
+    return current
+
+
+def _stop_profiler(profiler, name, config):
+    profiler.disable()
+    _local.profiling = False
+
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    filename = f"{name}-{os.getpid()}-{stamp}.prof"
+    profiler.dump_stats(os.path.join(config["profile_dir"], filename))
+
+
+def _stop_trace(start):
+    """peak above what was allocated as the stage began"""
+    stack = _local.peaks
+    _, peak = tracemalloc.get_traced_memory()
+    peak = max(stack.pop(), peak)
+
+    if stack:
+        stack[-1] = max(stack[-1], peak)
+    else:
+        with _lock:
+            _traced_threads.discard(threading.get_ident())
+
+    return peak - start
+
+
+def _write(record, config):
+    line = json.dumps(record, default=str)
+
+    with _lock:
+        with open(config["path"], "a") as file:
+            file.write(f"{line}\n")
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
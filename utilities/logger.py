@@ -1,9 +1,20 @@
+from logging.handlers import QueueHandler
+from datetime import datetime
+import multiprocessing
+import threading
 import logging
+import queue
+import json
+import time
 import os
 
 
 LOG_DIR = f"{os.pardir}{os.sep}logs{os.sep}"
 
+QUEUE_LOGGER = f"{__name__}.queue"
+
+_record_attributes = set(vars(logging.makeLogRecord({}))) | {"message"}
+
 
 def create_logger(log_file):
     """user responsible for file extension"""
@@ -29,7 +40,148 @@ def create_logger(log_file):
     return logger
 
 
+def create_queue_logger(log_queue, level=logging.INFO):
+    """records put on log_queue, for a FlowLogListener to write, never
+    touching a file in the calling thread or process
+    """
+    logger = logging.getLogger(QUEUE_LOGGER)
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+
+    return logger
+
+
+def init_worker(log_queue):
+    """pool initializer, so that pool workers log through log_queue"""
+    create_queue_logger(log_queue)
+
+
+def log_event(event, message=None, level=logging.INFO, **fields):
+    """structured record on the queue logger, quarter, sheet and the like as
+    fields; a no-op unless create_queue_logger was called in this process
+    """
+    logger = logging.getLogger(QUEUE_LOGGER)
+
+    if logger.isEnabledFor(level) and logger.handlers:
+        logger.log(level, message or event, extra={"event": event, **fields})
+
+
 def reset_logger(log_file):
+    """live handlers of the file closed before it is removed"""
     existing_log_file = f"{LOG_DIR}{log_file}.log"
+    logger = logging.getLogger(__name__)
+
+    for handler in list(logger.handlers):
+        path = getattr(handler, "baseFilename", None)
+
+        if path == os.path.abspath(existing_log_file):
+            logger.removeHandler(handler)
+            handler.close()
+
     if os.path.isfile(existing_log_file):
         os.remove(existing_log_file)
+
+
+class FlowLogListener:
+    """one background thread taking records off a queue that any thread or
+    process may log to, written in batches as json lines to
+    LOG_DIR/<log_file>.jsonl
+
+    with FlowLogListener("extraction") as listener:
+        logger = create_queue_logger(listener.queue)
+    """
+
+    _stop = None
+
+    def __init__(self, log_file, batch_size=100, flush_interval=0.5):
+        self.path = f"{LOG_DIR}{log_file}.jsonl"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = multiprocessing.Queue()
+        self.records_written = 0
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        if not os.path.isdir(LOG_DIR):
+            os.mkdir(LOG_DIR)
+
+        self._thread = threading.Thread(target=self._listen, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """records queued so far written, then the listener ended and its
+        queue detached from the queue logger
+        """
+        if self._thread is None:
+            return
+
+        self.queue.put(self._stop)
+        self._thread.join()
+        self._thread = None
+
+        queue_logger = logging.getLogger(QUEUE_LOGGER)
+
+        for handler in list(queue_logger.handlers):
+            if getattr(handler, "queue", None) is self.queue:
+                queue_logger.removeHandler(handler)
+
+    @staticmethod
+    def _as_json(record):
+        """level, message and origin of the record, plus every extra field"""
+        fields = {
+            "time": datetime.fromtimestamp(record.created).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+
+        for name, value in vars(record).items():
+            if name not in _record_attributes:
+                fields[name] = value
+
+        return json.dumps(fields, default=str)
+
+    def _listen(self):
+        stopped = False
+
+        while not stopped:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(
+                        self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+
+            stopped = self._stop in batch
+            self._write([record for record in batch if record is not self._stop])
+
+    def _write(self, records):
+        if not records:
+            return
+
+        lines = "".join(f"{self._as_json(record)}\n" for record in records)
+
+        with open(self.path, "a") as file:
+            file.write(lines)
+
+        self.records_written += len(records)
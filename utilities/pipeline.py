@@ -0,0 +1,310 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from utilities.data_cleaner import AnalysisCleaner, CISFundsCleaner
+from utilities.preprocessing import run_preprocessing
+from utilities.checkpoint import FlowCheckpoints, fingerprint
+from utilities.data_profiler import FlowDataProfiler
+from utilities.download_cache import WorkbookCache
+from utilities.star_schema import FlowStarSchema
+from utilities.asisa_scraper import scrape_excel
+from utilities.sheet_cache import SheetCache
+from utilities.export import ExcelExport
+from utilities import instrumentation
+from collections import namedtuple
+import pandas as pd
+import argparse
+import json
+import time
+import os
+
+
+WORK_DIR = f"{os.pardir}{os.sep}pipeline{os.sep}"
+ASSET_DIR = f"{os.pardir}{os.sep}assets{os.sep}"
+
+Stage = namedtuple("Stage", ["name", "inputs", "run"])
+
+
+class FlowPipeline:
+    """ingestion as a graph of stages, each run once its inputs are ready,
+    stages independent of one another side by side on a thread pool
+
+    every stage's output is checkpointed under work_dir as arrow files, see
+    FlowCheckpoints, so that a run can start part way, memory mapping the
+    outputs of earlier stages from a past run
+
+    each checkpoint carries a fingerprint of the inputs it came from, the
+    scraped workbooks by content, any later stage by the fingerprints of
+    its inputs; with resume a stage whose checkpoint matches is loaded
+    rather than run, a stale one is run again. scrape, the source, and
+    export, writing the workbook, always run
+    """
+
+    def __init__(
+        self,
+        work_dir=WORK_DIR,
+        workers=2,
+        cache_dir=None,
+        filename="data_ingestion_prep_asisa_flows",
+        resume=False,
+        compact=False,
+    ):
+        """workers, stages run at once and workers used within a stage
+        cache_dir keeps downloaded workbooks, parsed sheets and profiled
+        quarters between runs
+        resume loads stages with valid checkpoints, listed in resumed
+        compact standardises str columns as categoricals, see
+        FlowStandardiser.standardise
+        """
+        self.work_dir = work_dir
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.filename = filename
+        self.resume = resume
+        self.compact = compact
+        self.timings = {}
+        self.resumed = []
+
+        self.stages = [
+            Stage("scrape", [], self._scrape),
+            Stage("preprocess", ["scrape"], self._preprocess),
+            Stage("profile", ["preprocess"], self._profile),
+            Stage("clean_analysis", ["preprocess"], self._clean_analysis),
+            Stage("clean_cis_funds", ["preprocess"], self._clean_cis_funds),
+            Stage("update", ["clean_analysis", "clean_cis_funds"], self._update),
+            Stage("star_schema", ["update", "clean_cis_funds"], self._star_schema),
+            Stage("export", ["star_schema"], self._export),
+        ]
+
+    def plan(self, start=None, stop=None):
+        """stages from start to stop in order, those run and, outside the
+        range, those whose output is loaded from work_dir
+        """
+        selected = self._select(start, stop)
+        names = [stage.name for stage in selected]
+
+        loaded = [
+            name for stage in selected for name in stage.inputs if name not in names
+        ]
+
+        rows = [(name, "load", []) for name in dict.fromkeys(loaded)]
+        rows += [(stage.name, "run", stage.inputs) for stage in selected]
+
+        return pd.DataFrame(
+            data=rows,
+            columns=["Stage", "Action", "Inputs"],
+        ).set_index("Stage")
+
+    def run(self, start=None, stop=None):
+        """outputs of the stages run, by stage name"""
+        plan = self.plan(start, stop)
+        pending = [stage for stage in self.stages if stage.name in plan.index]
+        pending = [stage for stage in pending if plan.Action[stage.name] == "run"]
+
+        checkpoints = FlowCheckpoints(self.work_dir)
+        self.resumed = []
+
+        outputs = {}
+        fingerprints = {}
+
+        for name in plan.index[plan.Action == "load"]:
+            outputs[name] = checkpoints.load(name)
+            fingerprints[name] = checkpoints.fingerprint_of(name)
+
+        # tracemalloc has one peak per process, traced stages run one at a time
+        stage_workers = 1 if instrumentation.is_tracing_memory() else self.workers
+
+        with ThreadPoolExecutor(max_workers=stage_workers) as executor:
+            running = {}
+
+            while pending or running:
+                for stage in [s for s in pending if self._is_ready(s, outputs)]:
+                    future = executor.submit(
+                        self._run_stage, stage, outputs, fingerprints, checkpoints
+                    )
+                    running[future] = stage
+                    pending.remove(stage)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage = running.pop(future)
+                    outputs[stage.name], fingerprints[stage.name] = future.result()
+
+        return {
+            name: output
+            for name, output in outputs.items()
+            if plan.Action[name] == "run"
+        }
+
+    def _clean_analysis(self, preprocessed):
+        analysis, _ = preprocessed
+        return AnalysisCleaner(analysis).analysis
+
+    def _clean_cis_funds(self, preprocessed):
+        _, cis_funds = preprocessed
+        return CISFundsCleaner(cis_funds).cis_funds
+
+    def _export(self, tables):
+        """tables as FlowStarSchema.to_excel writes them"""
+        os.makedirs(ASSET_DIR, exist_ok=True)
+
+        path = f"{ASSET_DIR}{self.filename}.xlsx"
+        ExcelExport(path, streaming=False).write(list(tables.items()))
+
+    def _fingerprint(self, stage, fingerprints):
+        """None for a stage with no inputs, fingerprinted by its output"""
+        if not stage.inputs:
+            return None
+
+        inputs = [stage.name] + [fingerprints[name] for name in stage.inputs]
+        return fingerprint(json.dumps(inputs))
+
+    @staticmethod
+    def _is_ready(stage, outputs):
+        return all(name in outputs for name in stage.inputs)
+
+    def _preprocess(self, workbooks):
+        sheet_cache = None
+
+        if self.cache_dir is not None:
+            sheet_cache = SheetCache(os.path.join(self.cache_dir, "sheets"))
+
+        return run_preprocessing(
+            workbooks.Workbook.tolist(),
+            workers=self.workers,
+            sheet_cache=sheet_cache,
+            compact=self.compact,
+            Analysis=0,
+            CISFunds=2,
+        )
+
+    def _profile(self, preprocessed):
+        _, cis_funds = preprocessed
+        profile_cache = None
+
+        if self.cache_dir is not None:
+            profile_cache = os.path.join(self.cache_dir, "profile")
+
+        return FlowDataProfiler(cache_dir=profile_cache).to_json(cis_funds)
+
+    def _run_stage(self, stage, outputs, fingerprints, checkpoints):
+        """output and fingerprint of the stage, loaded where resumable"""
+        start = time.perf_counter()
+        stage_fingerprint = self._fingerprint(stage, fingerprints)
+
+        resumable = self.resume and stage.name != "export"
+
+        if resumable and checkpoints.is_valid(stage.name, stage_fingerprint):
+            self.resumed.append(stage.name)
+            output = checkpoints.load(stage.name)
+            self.timings[stage.name] = time.perf_counter() - start
+            return output, stage_fingerprint
+
+        inputs = [outputs[name] for name in stage.inputs]
+
+        with instrumentation.stage(f"pipeline.{stage.name}") as record:
+            output = stage.run(*inputs)
+            record["rows_out"] = instrumentation.count_rows(output)
+
+        if stage_fingerprint is None:
+            stage_fingerprint = fingerprint(output)
+
+        checkpoints.save(stage.name, output, stage_fingerprint)
+
+        self.timings[stage.name] = time.perf_counter() - start
+        return output, stage_fingerprint
+
+    def _scrape(self):
+        cache = None
+
+        if self.cache_dir is not None:
+            cache = WorkbookCache(os.path.join(self.cache_dir, "workbooks"))
+
+        workbooks = scrape_excel("flow", workers=self.workers, cache=cache)
+        return pd.DataFrame({"Workbook": workbooks})
+
+    def _select(self, start, stop):
+        names = [stage.name for stage in self.stages]
+
+        for name in (start, stop):
+            if name is not None and name not in names:
+                raise ValueError(f"stage must be one of {names}, not {name}")
+
+        first = names.index(start) if start is not None else 0
+        last = names.index(stop) if stop is not None else len(names) - 1
+
+        return self.stages[first : last + 1]
+
+    def _star_schema(self, analysis, cis_funds):
+        """tables by name, as FlowStarSchema.get_tables"""
+        star_schema = FlowStarSchema(
+            analysis=analysis,
+            cis_funds_fund_data=cis_funds["funds_operational"],
+            cis_funds_sector_data=cis_funds["sectors"],
+        )
+
+        return dict(star_schema.get_tables())
+
+    def _update(self, analysis, cis_funds):
+        return AnalysisCleaner(analysis, prepped=True).update(
+            analysis=analysis,
+            cis_funds=cis_funds,
+        )
+
+
+def main(argv=None):
+    pipeline = FlowPipeline()
+    stage_names = [stage.name for stage in pipeline.stages]
+
+    parser = argparse.ArgumentParser(
+        description="Scrape, prep and export ASISA Flows as a star schema",
+    )
+    parser.add_argument("--start", choices=stage_names, help="first stage run")
+    parser.add_argument("--stop", choices=stage_names, help="last stage run")
+    parser.add_argument("--dry-run", action="store_true", help="print the plan")
+    parser.add_argument("--workers", type=int, default=pipeline.workers)
+    parser.add_argument("--work-dir", default=pipeline.work_dir)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--filename", default=pipeline.filename)
+    parser.add_argument(
+        "--resume", action="store_true", help="load stages checkpointed as valid"
+    )
+    parser.add_argument(
+        "--compact", action="store_true", help="str columns as categoricals"
+    )
+    parser.add_argument("--metrics", help="json lines file of stage metrics")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--profile-dir", help="cProfile dump of every stage")
+    args = parser.parse_args(argv)
+
+    if args.metrics is None and (args.trace_memory or args.profile_dir):
+        parser.error("--trace-memory and --profile-dir need --metrics")
+
+    pipeline = FlowPipeline(
+        work_dir=args.work_dir,
+        workers=args.workers,
+        cache_dir=args.cache_dir,
+        filename=args.filename,
+        resume=args.resume,
+        compact=args.compact,
+    )
+
+    if args.dry_run:
+        print(pipeline.plan(args.start, args.stop).to_string())
+        return
+
+    if args.metrics is not None:
+        instrumentation.enable(
+            args.metrics,
+            trace_memory=args.trace_memory,
+            profile_dir=args.profile_dir,
+        )
+
+    pipeline.run(args.start, args.stop)
+
+    for name, seconds in pipeline.timings.items():
+        resumed = " (checkpoint)" if name in pipeline.resumed else ""
+        print(f"{name}: {seconds:.2f}s{resumed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,42 @@
+from concurrent.futures import ProcessPoolExecutor
+from utilities.sheet_cache import SheetCache, nan_for_null
+from utilities import logger, compact, instrumentation
 from datetime import datetime
-from utilities import logger
-from copy import deepcopy
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import openpyxl
+import hashlib
+import pickle
+import json
+import xlrd
 import re
+import io
 import os
 
 
+_xls_signature = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+
 class FlowExtractor:
+    _date_key = "Date_Key"
     _log_name = "quarters_with_no_cis_funds"
 
-    def __init__(self):
-        logger.reset_logger(self._log_name)
-        self.logger = logger.create_logger(self._log_name)
+    def __init__(self, workers=1, sheet_cache=None, log_listener=None):
+        """log_listener, a FlowLogListener, takes records as json from here
+        and from pool workers in place of the error log file
+        """
+        if log_listener is None:
+            logger.reset_logger(self._log_name)
+            self.logger = logger.create_logger(self._log_name)
+            self._log_queue = None
+        else:
+            self.logger = logger.create_queue_logger(log_listener.queue)
+            self._log_queue = log_listener.queue
+
+        self.sheet_cache = sheet_cache
+        self.workers = workers
+        self._dates = {}
 
     def extract_sheets(self, excel_files, sheet_name, header):
         dates = [self._get_date(file) for file in excel_files]
@@ -28,26 +53,142 @@ class FlowExtractor:
                     axis="index",
                 )
             except ValueError:
-                event = "EVENT:\t Unable to ingest CIS Funds data"
-                reason = "REASON:\t No Data"
-                quarter = f"QUARTER: {date}"
-                error = f"\n\t{event}\n\t{reason}\n\t{quarter}\n"
-                self.logger.error(error)
+                self._log_missing_sheet(date, sheet_name)
+
+        return sheets
+
+    @instrumentation.instrument("extract_workbooks")
+    def extract_workbooks(self, excel_files, **sheet_to_header_map):
+        """each workbook opened once, all sheets and its date read from it
+        returns {sheet_name: {date: sheet}}, as extract_sheets per sheet
+
+        with workers > 1 workbooks are parsed in a process pool, missing
+        sheets are reported back and logged here in workbook order
+
+        with a sheet_cache only sheets not cached are parsed, a workbook
+        whose sheets are all cached is never opened
+        """
+        sheets = {sheet_name: {} for sheet_name in sheet_to_header_map}
+
+        keys = [_workbook_key(excel) for excel in excel_files]
+        digests = [self._digest(excel) for excel in excel_files]
+        workbooks = [
+            self._load_cached(digest, sheet_to_header_map) for digest in digests
+        ]
+
+        unread = [
+            index
+            for index, (date, cached) in enumerate(workbooks)
+            if len(cached) < len(sheet_to_header_map)
+        ]
+
+        unread_sheets = [
+            {
+                sheet_name: header
+                for sheet_name, header in sheet_to_header_map.items()
+                if sheet_name not in workbooks[index][1]
+            }
+            for index in unread
+        ]
+
+        parsed = self._read_workbooks(
+            excel_files=[excel_files[index] for index in unread],
+            dates=[self._dates.get(keys[index]) for index in unread],
+            sheet_maps=unread_sheets,
+        )
+
+        for index, sheet_map, (date, read) in zip(unread, unread_sheets, parsed):
+            self._store_cached(digests[index], date, read, sheet_map)
+            workbooks[index] = (date, {**workbooks[index][1], **read})
+
+        for key, (date, workbook_sheets) in zip(keys, workbooks):
+            self._dates[key] = date
+
+            for sheet_name in sheet_to_header_map:
+                sheet = workbook_sheets[sheet_name]
+
+                if sheet is None:
+                    self._log_missing_sheet(date, sheet_name)
+                else:
+                    sheets[sheet_name][date] = sheet
 
         return sheets
 
+    def quarter_manifest(self, excel_files):
+        """Date_Key of each workbook, indexed by position in excel_files,
+        read from the AA banner alone, so workbooks can be sorted,
+        deduplicated or filtered before any sheet is parsed:
+        [excel_files[index] for index in manifest.index]
+        """
+        manifest = pd.DataFrame(
+            data={self._date_key: [self._get_date(excel) for excel in excel_files]},
+        )
+        manifest.index.name = "Workbook"
+        return manifest
+
+    def _digest(self, excel):
+        if self.sheet_cache is None:
+            return None
+        return self.sheet_cache.digest(excel)
+
     def _get_date(self, excel):
+        """memoised per workbook"""
+        key = _workbook_key(excel)
+
+        if key not in self._dates:
+            self._dates[key] = self._parse_date(excel)
+
+        return self._dates[key]
+
+    def _log_missing_sheet(self, date, sheet_name):
+        event = "EVENT:\t Unable to ingest CIS Funds data"
+        reason = "REASON:\t No Data"
+        quarter = f"QUARTER: {date}"
+        error = f"\n\t{event}\n\t{reason}\n\t{quarter}\n"
+        self.logger.error(
+            error,
+            extra={
+                "event": "missing_sheet",
+                "reason": "No Data",
+                "quarter": date,
+                "sheet": sheet_name,
+            },
+        )
+
+    def _load_cached(self, digest, sheet_to_header_map):
+        """(date, {sheet_name: sheet}) of the sheets found in the cache"""
+        if self.sheet_cache is None:
+            return None, {}
+
+        date = self.sheet_cache.load_date(digest)
+        cached = {}
+
+        if date is None:
+            # workbook never cached, every sheet looked up is a miss
+            self.sheet_cache.misses += len(sheet_to_header_map)
+            return None, cached
+
+        for sheet_name, header in sheet_to_header_map.items():
+            try:
+                cached[sheet_name] = self.sheet_cache.load(digest, sheet_name, header)
+            except KeyError:
+                continue
+
+        return date, cached
+
+    @classmethod
+    def _parse_date(cls, excel):
         """AA sheet present in all publications
         expected format:
         <day: int>/<month[full word]: str>/<year: int>
         """
         index_zero = 0
 
-        aa_sheet = pd.read_excel(excel, header=None, sheet_name="AA")
+        first_row = cls._sniff_first_row(excel, sheet_name="AA")
 
         end_of_quarter_entries = [
             entry
-            for entry in aa_sheet.iloc[index_zero].unique()
+            for entry in dict.fromkeys(first_row)
             if type(entry) is str and "quarter ended" in entry.lower()
         ][index_zero]
 
@@ -56,7 +197,117 @@ class FlowExtractor:
             string=end_of_quarter_entries,
         )[index_zero]
 
-        return self._format_publication_date(quarter)
+        return cls._format_publication_date(quarter)
+
+    @classmethod
+    def _read_workbook(cls, excel, date, sheet_to_header_map):
+        """runs in pool workers: a missing sheet comes back as None, logged
+        by the parent in workbook order; sheets read are only logged through
+        the queue logger, if set up
+        """
+        sheets = {}
+
+        with instrumentation.stage("read_workbook") as record:
+            with pd.ExcelFile(excel) as workbook:
+                if date is None:
+                    date = cls._parse_date(workbook)
+
+                for sheet_name, header in sheet_to_header_map.items():
+                    try:
+                        sheets[sheet_name] = workbook.parse(
+                            sheet_name=sheet_name,
+                            header=header,
+                        ).dropna(
+                            how="all",
+                            axis="index",
+                        )
+                    except ValueError:
+                        sheets[sheet_name] = None
+
+            record["date"] = date
+            record["rows_out"] = sum(
+                sheet.shape[0] for sheet in sheets.values() if sheet is not None
+            )
+
+        for sheet_name, sheet in sheets.items():
+            if sheet is not None:
+                logger.log_event(
+                    "sheet_read",
+                    quarter=date,
+                    sheet=sheet_name,
+                    rows=sheet.shape[0],
+                )
+
+        return date, sheets
+
+    def _read_workbooks(self, excel_files, dates, sheet_maps):
+        if self.workers <= 1:
+            return list(map(self._read_workbook, excel_files, dates, sheet_maps))
+
+        initializer = None if self._log_queue is None else logger.init_worker
+
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=initializer,
+            initargs=(self._log_queue,),
+        ) as executor:
+            return list(
+                executor.map(self._read_workbook, excel_files, dates, sheet_maps)
+            )
+
+    def _store_cached(self, digest, date, sheets, sheet_to_header_map):
+        if self.sheet_cache is None:
+            return
+
+        self.sheet_cache.store_date(digest, date)
+
+        for sheet_name, header in sheet_to_header_map.items():
+            self.sheet_cache.store(digest, sheet_name, header, sheets[sheet_name])
+
+    @staticmethod
+    def _sniff_first_row(excel, sheet_name):
+        """first row of one sheet, without loading the rest of the workbook
+        read the way pd.read_excel would read it, header=None
+        """
+        if isinstance(excel, pd.ExcelFile):
+            sheet = excel.parse(sheet_name=sheet_name, header=None, nrows=1)
+            return sheet.iloc[0].tolist()
+
+        if isinstance(excel, bytes):
+            in_memory = True
+            signature = excel[: len(_xls_signature)]
+        elif isinstance(excel, (str, os.PathLike)):
+            in_memory = False
+            with open(excel, "rb") as file:
+                signature = file.read(len(_xls_signature))
+        else:
+            sheet = pd.read_excel(excel, sheet_name=sheet_name, header=None, nrows=1)
+            return sheet.iloc[0].tolist()
+
+        if signature == _xls_signature:
+            if in_memory:
+                workbook = xlrd.open_workbook(file_contents=excel, on_demand=True)
+            else:
+                workbook = xlrd.open_workbook(excel, on_demand=True)
+
+            try:
+                return workbook.sheet_by_name(sheet_name).row_values(0)
+            finally:
+                workbook.release_resources()
+
+        workbook = openpyxl.load_workbook(
+            io.BytesIO(excel) if in_memory else excel,
+            read_only=True,
+            data_only=True,
+            keep_links=False,
+        )
+
+        try:
+            sheet = workbook[sheet_name]
+            sheet.reset_dimensions()
+            return [cell.value for cell in next(sheet.rows)]
+        finally:
+            workbook.close()
 
     @staticmethod
     def _format_publication_date(date_str):
@@ -81,64 +332,288 @@ class FlowStandardiser:
 
     _date_key = "Date_Key"
 
+    def __init__(self, compact=False):
+        self.compact = compact
+        self._headers = {}
+
+    @instrumentation.instrument("standardise")
     def standardise(self, sheets):
-        sheets = deepcopy(sheets)
+        """a single flatten of all quarters, strings then normalised column by
+        column over the whole history, sheets left untouched
 
-        sheets_std_header = {
-            date: self._standardise_header(sheet) for date, sheet in sheets.items()
-        }
+        compact returns str columns as categoricals, categories shared by
+        all quarters, and measures downcast where no value changes
+        """
+        sheets_std_header = {}
+        str_columns = {}
 
-        sheets_no_lead_trail_whitespace = {
-            date: self._strip_lead_trail_whitespace_from_values(sheet)
-            for date, sheet in sheets_std_header.items()
-        }
+        for date, sheet in sheets.items():
+            sheet, str_columns[date] = self._standardise_header(sheet)
+            sheets_std_header[date] = sheet
 
-        return self._flatten(sheets_no_lead_trail_whitespace)
+        sheets_flat = self._flatten(sheets_std_header)
+        sheets_flat = self._strip_lead_trail_whitespace_from_values(
+            sheets_flat, str_columns
+        )
+
+        return compact.compact(sheets_flat) if self.compact else sheets_flat
 
     def _flatten(self, sheets):
-        for date, sheet in sheets.items():
-            sheet[self._date_key] = date
-            sheet.set_index(self._date_key)
-            sheet.index.name = self._date_key
-            sheets[date] = sheet
+        sheets_flat = pd.concat(
+            objs=sheets.values(),
+            keys=sheets.keys(),
+            names=[self._date_key, None],
+        )
+
+        return sheets_flat.droplevel(1)
+
+    def _fix_header(self, columns):
+        """computed once per distinct header, quarters mostly share one"""
+        key = tuple(columns)
+
+        if key not in self._headers:
+            corrective_pairings = [
+                self._corrective_char_regex,
+                self._corrective_headers,
+            ]
+
+            for pairings in corrective_pairings:
+                for pattern, replace in pairings:
+                    columns = columns.str.replace(pattern, replace, regex=True)
 
-        sheets_flat = pd.concat(sheet for sheet in sheets.values())
+            self._headers[key] = columns
 
-        return sheets_flat.set_index(self._date_key)
+        return self._headers[key]
+
+    @staticmethod
+    def _normalise_values(series):
+        """upper cased and stripped once per distinct value, the values of
+        a column being few and much repeated
+        """
+        codes, uniques = pd.factorize(series.astype(str))
+        normalised = uniques.str.upper().str.strip().to_numpy()
+        return pd.Series(normalised[codes], index=series.index, name=series.name)
 
     def _standardise_header(self, sheet):
-        corrective_pairings = [
-            self._corrective_char_regex,
-            self._corrective_headers,
+        """header fixed and str columns moved ahead of the rest, as each
+        quarter is laid out once standardised
+
+        returns the sheet and its str columns
+        """
+        columns = self._fix_header(sheet.columns)
+
+        objs = (sheet.dtypes == "object").to_numpy()
+        order = np.concatenate([np.flatnonzero(objs), np.flatnonzero(~objs)])
+
+        sheet = sheet.iloc[:, order]
+        sheet.columns = columns[order]
+
+        return sheet, columns[objs]
+
+    def _strip_lead_trail_whitespace_from_values(self, sheets_flat, str_columns):
+        """only rows of quarters where a column held str are normalised,
+        elsewhere a column may be numeric or absent, left as is
+        """
+        quarters = sheets_flat.index
+
+        column_quarters = {}
+        for date, columns in str_columns.items():
+            for column in columns:
+                column_quarters.setdefault(column, []).append(date)
+
+        for column, dates in column_quarters.items():
+            if len(dates) == len(str_columns):
+                sheets_flat[column] = self._normalise_values(sheets_flat[column])
+                continue
+
+            rows = quarters.isin(dates)
+            normalised = self._normalise_values(sheets_flat.loc[rows, column])
+            sheets_flat.loc[rows, column] = normalised.to_numpy()
+
+        return sheets_flat
+
+
+class FlowIncrementalPreprocessor:
+    """run_preprocessing that keeps its standardised sheets in state_dir,
+    along with the digest of the workbook behind each quarter
+
+    a rerun extracts and standardises only workbooks not seen before,
+    new quarters or republished ones, and reuses every other quarter
+    """
+
+    _date_key = "Date_Key"
+    _manifest_name = "manifest.json"
+
+    def __init__(self, state_dir, workers=1, sheet_cache=None):
+        self.state_dir = state_dir
+        self.workers = workers
+        self.sheet_cache = sheet_cache
+        self.changed_quarters = []
+
+        os.makedirs(state_dir, exist_ok=True)
+
+    def run(self, excel_files, **sheet_to_header_map):
+        """returns a list of sheets, as run_preprocessing"""
+        manifest = self._read_manifest()
+        previous = manifest.get("workbooks", {})
+
+        if manifest.get("sheets") != sheet_to_header_map:
+            previous = {}
+
+        stored = self._read_sheets(sheet_to_header_map) if previous else None
+
+        # a sheet missing or unreadable, every workbook is extracted again
+        if stored is None:
+            previous = {}
+
+        digests = [SheetCache.digest(excel) for excel in excel_files]
+        unseen = [
+            index for index, digest in enumerate(digests) if digest not in previous
         ]
 
-        for pairings in corrective_pairings:
-            for pattern, replace in pairings:
-                sheet.columns = sheet.columns.str.replace(pattern, replace, regex=True)
+        extractor = FlowExtractor(self.workers, self.sheet_cache)
+        extracted = extractor.extract_workbooks(
+            [excel_files[index] for index in unseen],
+            **sheet_to_header_map,
+        )
 
-        return sheet
+        dates = [previous.get(digest) for digest in digests]
+        for index in unseen:
+            dates[index] = extractor._get_date(excel_files[index])
 
-    @staticmethod
-    def _strip_lead_trail_whitespace_from_values(sheet):
-        objs = sheet.dtypes == "object"
+        self.changed_quarters = [dates[index] for index in unseen]
+        standardiser = FlowStandardiser()
+        processed = []
+
+        for sheet_name in sheet_to_header_map:
+            quarters = stored[sheet_name] if previous else {}
 
-        is_str = objs[objs].index
-        str_ = sheet[is_str].astype(str).applymap(str.upper).applymap(str.strip)
+            for date in self.changed_quarters:
+                quarters.pop(date, None)
 
-        is_not_str = objs[~objs].index
-        str_not = sheet[is_not_str]
+            if extracted[sheet_name]:
+                standardised = standardiser.standardise(extracted[sheet_name])
+                quarters.update(self._by_quarter(standardised))
 
-        return pd.concat([str_, str_not], axis="columns")
+            processed.append(self._in_workbook_order(quarters, dates))
 
+        self._write_state(processed, digests, dates, sheet_to_header_map)
+        return processed
 
-def run_preprocessing(excel_files, **sheet_to_header_map):
-    extractor = FlowExtractor()
-    standardiser = FlowStandardiser()
+    def _by_quarter(self, sheet):
+        return {date: quarter for date, quarter in sheet.groupby(level=0, sort=False)}
+
+    def _in_workbook_order(self, quarters, dates):
+        ordered = [quarters[date] for date in dict.fromkeys(dates) if date in quarters]
+        return pd.concat(ordered)
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _read_manifest(self):
+        if not os.path.isfile(self._path(self._manifest_name)):
+            return {}
+
+        with open(self._path(self._manifest_name)) as file:
+            return json.load(file)
+
+    def _read_sheet(self, sheet_name):
+        """quarters of the sheet held, None if missing or unreadable"""
+        path = self._path(sheet_name)
+
+        try:
+            if os.path.isfile(f"{path}.pkl"):
+                with open(f"{path}.pkl", "rb") as file:
+                    return self._by_quarter(pickle.load(file))
+
+            sheet = pd.read_parquet(f"{path}.parquet")
+        except (OSError, EOFError, pickle.UnpicklingError, pa.ArrowException):
+            return None
+
+        return self._by_quarter(nan_for_null(sheet))
+
+    def _read_sheets(self, sheet_to_header_map):
+        """quarters of each sheet held, None unless every sheet is"""
+        stored = {name: self._read_sheet(name) for name in sheet_to_header_map}
+
+        if any(quarters is None for quarters in stored.values()):
+            return None
+
+        return stored
+
+    def _write_sheet(self, sheet_name, sheet):
+        """parquet, or a pickle where arrow cannot hold the sheet as it is,
+        a column text in some quarters and numeric in others say
+        """
+        path = self._path(sheet_name)
+
+        try:
+            sheet.to_parquet(f"{path}.parquet.part")
+        except (pa.ArrowInvalid, pa.ArrowTypeError, ValueError):
+            with open(f"{path}.pkl.part", "wb") as file:
+                pickle.dump(sheet, file)
+
+            written, stale = f"{path}.pkl", f"{path}.parquet"
+        else:
+            written, stale = f"{path}.parquet", f"{path}.pkl"
+
+        os.replace(f"{written}.part", written)
+
+        if os.path.isfile(stale):
+            os.remove(stale)
+
+    def _write_state(self, processed, digests, dates, sheet_to_header_map):
+        """sheets written with no manifest in place, the manifest written
+        last, so that a run cut short leaves no manifest to trust
+        """
+        path = self._path(self._manifest_name)
+
+        if os.path.isfile(path):
+            os.remove(path)
+
+        for sheet_name, sheet in zip(sheet_to_header_map, processed):
+            self._write_sheet(sheet_name, sheet)
+
+        manifest = {
+            "sheets": sheet_to_header_map,
+            "workbooks": dict(zip(digests, dates)),
+        }
+
+        with open(f"{path}.part", "w") as file:
+            json.dump(manifest, file, indent=1)
+
+        os.replace(f"{path}.part", path)
+
+
+@instrumentation.instrument("run_preprocessing")
+def run_preprocessing(
+    excel_files,
+    workers=1,
+    sheet_cache=None,
+    compact=False,
+    log_listener=None,
+    **sheet_to_header_map,
+):
+    """workers > 1 parses workbooks in that many processes
+    sheet_cache, a SheetCache, skips parsing sheets parsed on earlier runs
+    compact, see FlowStandardiser.standardise
+    log_listener, see FlowExtractor
+    """
+    extractor = FlowExtractor(workers, sheet_cache, log_listener)
+    standardiser = FlowStandardiser(compact)
     processed = []
 
-    for sheet, header in sheet_to_header_map.items():
-        extracted = extractor.extract_sheets(excel_files, sheet, header)
-        standardised = standardiser.standardise(extracted)
+    extracted = extractor.extract_workbooks(excel_files, **sheet_to_header_map)
+
+    for sheet in sheet_to_header_map:
+        standardised = standardiser.standardise(extracted[sheet])
         processed.append(standardised)
 
     return processed
+
+
+def _workbook_key(excel):
+    """content digest for workbooks held in memory, else the path"""
+    if isinstance(excel, bytes):
+        return hashlib.sha256(excel).hexdigest()
+    return excel
@@ -0,0 +1,146 @@
+import pyarrow.parquet as pq
+import pyarrow as pa
+import pandas as pd
+import numpy as np
+import hashlib
+import os
+
+
+def arrow_compatible(frame):
+    """object columns arrow cannot type, say ints mixed with strings, as str"""
+    frame = frame.copy(deep=False)
+
+    for column in frame.columns[frame.dtypes == "object"]:
+        try:
+            pa.array(frame[column].to_numpy(), from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            frame[column] = frame[column].astype(str)
+
+    return frame
+
+
+def nan_for_null(sheet):
+    """arrow hands back empty cells of object columns as None,
+    read_excel gives NaN, and str(None) would differ from str(nan)
+
+    columns without nulls are left as they are, views of arrow memory say
+    """
+    for column in sheet.columns[sheet.dtypes == "object"]:
+        if not sheet[column].isna().any():
+            continue
+
+        values = sheet[column].to_numpy(dtype=object, copy=True)
+        values[pd.isna(values)] = np.nan
+        sheet[column] = values
+
+    return sheet
+
+
+class SheetCache:
+    """parsed sheets kept as parquet, keyed by workbook content, sheet name
+    and header row, so an unchanged workbook is never parsed from excel twice
+
+    layout:
+    <cache_dir>/<digest>.date, quarter date of the workbook
+    <cache_dir>/<digest>-<sheet key>.parquet, a parsed sheet
+    <cache_dir>/<digest>-<sheet key>.missing, sheet absent from the workbook
+    """
+
+    _chunk_size = 1024 * 1024
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def stats(self):
+        """counts sheet lookups, bytes are parquet bytes read and written"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+        }
+
+    @classmethod
+    def digest(cls, excel):
+        """workbook as bytes or path"""
+        sha256 = hashlib.sha256()
+
+        if isinstance(excel, bytes):
+            sha256.update(excel)
+            return sha256.hexdigest()
+
+        with open(excel, "rb") as file:
+            for chunk in iter(lambda: file.read(cls._chunk_size), b""):
+                sha256.update(chunk)
+
+        return sha256.hexdigest()
+
+    def invalidate(self, digest=None):
+        """drop one workbook's entries, or everything if no digest given"""
+        for name in os.listdir(self.cache_dir):
+            if digest is None or name.startswith(digest):
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def load(self, digest, sheet_name, header):
+        """parsed sheet, None if the workbook lacks it, KeyError if not cached"""
+        path = self._sheet_path(digest, sheet_name, header)
+
+        if os.path.isfile(f"{path}.missing"):
+            self.hits += 1
+            return None
+
+        if not os.path.isfile(f"{path}.parquet"):
+            self.misses += 1
+            raise KeyError((digest, sheet_name, header))
+
+        self.hits += 1
+        self.bytes_read += os.path.getsize(f"{path}.parquet")
+        return nan_for_null(pq.read_table(f"{path}.parquet").to_pandas())
+
+    def load_date(self, digest):
+        path = os.path.join(self.cache_dir, f"{digest}.date")
+
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as file:
+            return int(file.read())
+
+    def store(self, digest, sheet_name, header, sheet):
+        """sheet None records that the workbook lacks it
+
+        object columns arrow cannot type, say ints mixed with strings, are
+        stored as str, as FlowStandardiser would make them anyway; sheets
+        with non-str headers are not cached, they would not round trip
+        """
+        path = self._sheet_path(digest, sheet_name, header)
+
+        if sheet is None:
+            open(f"{path}.missing", "w").close()
+            return
+
+        if not all(isinstance(column, str) for column in sheet.columns):
+            return
+
+        table = pa.Table.from_pandas(arrow_compatible(sheet))
+        pq.write_table(table, f"{path}.part")
+        os.replace(f"{path}.part", f"{path}.parquet")
+
+        self.bytes_written += os.path.getsize(f"{path}.parquet")
+
+    def store_date(self, digest, date):
+        path = os.path.join(self.cache_dir, f"{digest}.date")
+
+        with open(path, "w") as file:
+            file.write(str(date))
+
+    def _sheet_path(self, digest, sheet_name, header):
+        sheet_key = hashlib.sha256(f"{sheet_name}\0{header}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}-{sheet_key[:16]}")
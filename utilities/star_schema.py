@@ -1,4 +1,7 @@
+from utilities.export import ExcelExport
+from utilities import instrumentation
 import pandas as pd
+import numpy as np
 import os
 
 
@@ -12,61 +15,84 @@ class FlowStarSchema:
         "Net_Flow_I",
     ]
 
-    def __init__(self, analysis, cis_funds_fund_data, cis_funds_sector_data):
+    def __init__(
+        self,
+        analysis,
+        cis_funds_fund_data,
+        cis_funds_sector_data,
+        strict=False,
+        date_grain="day",
+        date_cache_dir=None,
+    ):
+        """strict raises where foreign keys are ambiguous or missing,
+        date_grain "quarter" keeps only quarter ends in the date dimension
+        """
         self.analysis = analysis
         self.cis_funds_fund_data = cis_funds_fund_data
         self.cis_funds_sector_data = cis_funds_sector_data
+        self.strict = strict
         self.dimensions = _FlowDimensions(
-            analysis, cis_funds_fund_data, cis_funds_sector_data
+            analysis,
+            cis_funds_fund_data,
+            cis_funds_sector_data,
+            date_grain,
+            date_cache_dir,
         )
         self.fact = self._generate_fact()
 
-    def to_excel(self, filename):
-        log_dir = f"{os.path.pardir}{os.path.sep}assets{os.path.sep}"
+    @instrumentation.instrument("export")
+    def export(self, backend, workers=1, include_original=True):
+        """tables written through backend, one of utilities.export, workers
+        tables at a time where the backend allows, per table timings kept
+        in export_timings
+        """
+        tables = self.get_tables(include_original)
+        self.export_timings = backend.write(tables, workers)
+        return self.export_timings
+
+    def get_tables(self, include_original=True):
+        """(name, frame) per table, fact first, as exported"""
+        tables = [
+            ("Fact_Assets", self.fact),
+            ("Dim_Date", self.dimensions.date),
+            ("Dim_CIS_Manager", self.dimensions.cis_manager),
+            ("Dim_Sector_Classification", self.dimensions.sector_classification),
+            ("Dim_Fund_Names", self.dimensions.fund_name),
+            ("Dim_Retail_Institutional", self.dimensions.retail_institutional),
+            ("Dim_Fund_of_Funds", self.dimensions.fund_of_funds),
+            ("Dim_Third_Party", self.dimensions.third_party),
+            ("Dim_Management_Style", self.dimensions.management_style),
+        ]
 
-        if not os.path.isdir(log_dir):
-            os.mkdir(log_dir)
+        if not include_original:
+            return tables
 
-        path = f"{log_dir}{filename}.xlsx"
+        original_cis_funds = pd.concat(
+            objs=[
+                self.cis_funds_fund_data,
+                self.cis_funds_sector_data,
+            ],
+            axis="columns",
+        )
 
-        sheets = [
-            (self.fact, "Fact_Assets"),
-            (self.dimensions.date, "Dim_Date"),
-            (self.dimensions.cis_manager, "Dim_CIS_Manager"),
-            (self.dimensions.sector_classification, "Dim_Sector_Classification"),
-            (self.dimensions.fund_name, "Dim_Fund_Names"),
-            (self.dimensions.retail_institutional, "Dim_Retail_Institutional"),
-            (self.dimensions.fund_of_funds, "Dim_Fund_of_Funds"),
-            (self.dimensions.third_party, "Dim_Third_Party"),
-            (self.dimensions.management_style, "Dim_Management_Style"),
-            (self.analysis, "Original_Analysis"),
-            (
-                pd.concat(
-                    objs=[
-                        self.cis_funds_fund_data,
-                        self.cis_funds_sector_data,
-                    ],
-                    axis="columns",
-                ),
-                "Original_CIS_Funds",
-            ),
+        return tables + [
+            ("Original_Analysis", self.analysis),
+            ("Original_CIS_Funds", original_cis_funds),
         ]
 
-        with pd.ExcelWriter(path, engine="openpyxl") as writer:
-            for df, sheet_name in sheets:
-                df.to_excel(writer, sheet_name=sheet_name)
+    def to_excel(self, filename, include_original=True):
+        log_dir = f"{os.path.pardir}{os.path.sep}assets{os.path.sep}"
 
-    def _generate_fact(self):
-        mapped_keys = self._map_keys()
+        if not os.path.isdir(log_dir):
+            os.mkdir(log_dir)
 
-        foreign_keys = pd.DataFrame(
-            data=(series.values for series in mapped_keys.values()),
-            index=mapped_keys.keys(),
-        ).T
+        path = f"{log_dir}{filename}.xlsx"
 
-        original_length = self.analysis.shape[0]
-        foreign_keys = foreign_keys.iloc[:original_length].reset_index(drop=True)
+        self.export(ExcelExport(path, streaming=False), 1, include_original)
 
+    @instrumentation.instrument("generate_fact")
+    def _generate_fact(self):
+        foreign_keys = pd.DataFrame(self._map_keys())
         measures = self._get_measures()
 
         fact = pd.concat([foreign_keys, measures], axis="columns")
@@ -79,30 +105,77 @@ class FlowStarSchema:
         return measures.reset_index(drop=True)
 
     def _map_keys(self):
-        mapped_keys = {self._date_key: self.analysis.index}
+        """one hash lookup per dimension, a single pass over analysis
+
+        a value matching several dimension members takes the first key,
+        one matching none a null key; both are listed in key_issues and
+        raise with strict
+        """
+        mapped_keys = {self._date_key: self.analysis.index.to_numpy()}
+        issues = []
 
         for feature in self.dimensions.feat_names:
             if feature == self._date_key:
                 continue
 
-            feature_dimension = self.dimensions.__getattribute__(
-                feature.lower()
-            ).reset_index()
+            dimension = self.dimensions.__getattribute__(feature.lower())
+            values = self.analysis[feature]
 
-            feature_key = f"{feature}_Key"
+            members = dimension[feature]
+            duplicated = members.duplicated(keep="first").to_numpy()
+            members_unique = pd.Index(members[~duplicated])
+            keys = dimension.index[~duplicated].to_numpy()
 
-            feature_key_mapped = pd.merge(
-                left=self.analysis,
-                right=feature_dimension,
-                how="left",
-                left_on=feature,
-                right_on=feature,
-            )[feature_key]
+            positions = self._get_positions(members_unique, values)
+            matched = positions >= 0
 
-            mapped_keys[feature_key] = feature_key_mapped
+            if matched.all():
+                mapped_keys[f"{feature}_Key"] = keys[positions]
+            else:
+                mapped_keys[f"{feature}_Key"] = np.where(
+                    matched, keys[positions].astype(float), np.nan
+                )
+
+            ambiguous = members[members.duplicated(keep=False)].unique()
+            issues += self._describe_issues(feature, values, ambiguous, "Ambiguous")
+
+            unmatched = values[~matched].unique()
+            issues += self._describe_issues(feature, values, unmatched, "Unmatched")
+
+        self.key_issues = pd.DataFrame(
+            data=issues,
+            columns=["Feature", "Value", "Issue", "Rows"],
+        )
+
+        if self.strict and not self.key_issues.empty:
+            raise ValueError(f"foreign keys not uniquely matched:\n{self.key_issues}")
 
         return mapped_keys
 
+    @staticmethod
+    def _describe_issues(feature, values, issue_values, issue):
+        if not len(issue_values):
+            return []
+
+        rows = pd.Series(np.asarray(values, dtype=object)).value_counts(dropna=False)
+        return [
+            (feature, value, issue, int(rows.get(value, 0)))
+            for value in np.asarray(issue_values, dtype=object)
+        ]
+
+    @staticmethod
+    def _get_positions(members, values):
+        """position of each value among members, -1 if absent; a
+        categorical is looked up once per category
+        """
+        if not isinstance(values.dtype, pd.CategoricalDtype):
+            return members.get_indexer(values)
+
+        categories = members.get_indexer(values.cat.categories)
+        codes = values.cat.codes.to_numpy()
+
+        return np.where(codes >= 0, categories[codes], members.get_indexer([np.nan]))
+
 
 class _FlowDimensions:
     feat_names = [
@@ -135,7 +208,15 @@ class _FlowDimensions:
         "Portfolio",
     ]
 
-    def __init__(self, analysis, cis_funds_fund_data, cis_funds_sector_data):
+    @instrumentation.instrument("generate_dimensions")
+    def __init__(
+        self,
+        analysis,
+        cis_funds_fund_data,
+        cis_funds_sector_data,
+        date_grain="day",
+        date_cache_dir=None,
+    ):
         self.analysis = analysis
         self.cis_funds_fund_data = cis_funds_fund_data
         self.cis_funds_sector_data = cis_funds_sector_data
@@ -147,12 +228,14 @@ class _FlowDimensions:
         self.third_party = self._get_dimension("Third_Party")
 
         self.fund_name = self._get_fund_name_dimension()
-        self.date = _DateDimension(analysis.index).get_dimension()
+        self.date = _DateDimension(
+            analysis.index, date_grain, date_cache_dir
+        ).get_dimension()
         self.sector_classification = self._get_sector_classification_dimension()
 
     def _get_dimension(self, feature_name):
         feature = self.analysis[feature_name]
-        data = feature.sort_values().unique()
+        data = self._sorted_unique(feature)
 
         dimension = pd.DataFrame(
             data=data,
@@ -167,7 +250,7 @@ class _FlowDimensions:
     def _get_fund_name_dimension(self):
         fund_name = "Fund_Name"
         feature = self.analysis[fund_name]
-        data = feature.sort_values().unique()
+        data = self._sorted_unique(feature)
 
         dimension = pd.DataFrame(
             data=data,
@@ -194,6 +277,14 @@ class _FlowDimensions:
 
         return self._standardise_dimension(classification, "Sector_Classification")
 
+    @staticmethod
+    def _sorted_unique(feature):
+        """feature.sort_values().unique(), uniques found first so that a
+        categorical feature sorts its few values, not every row
+        """
+        uniques = pd.Series(np.asarray(feature.unique(), dtype=object))
+        return uniques.sort_values().to_numpy()
+
     @staticmethod
     def _standardise_dimension(dimension, feature_name):
         dimension.sort_values(by=feature_name, inplace=True)
@@ -203,56 +294,156 @@ class _FlowDimensions:
 
 
 class _DateDimension:
-    def __init__(self, date_keys):
-        self.date_range = self._get_date_range(date_keys)
+    """calendar over every year of the date keys, one row per day, or per
+    quarter end with grain "quarter", the only dates the fact references
+
+    calendars are kept per grain, in memory and under cache_dir if given,
+    and only extended by the years they lack
+    """
+
+    _grains = ("day", "quarter")
+
+    _month_names = np.array(
+        [
+            "JANUARY",
+            "FEBRUARY",
+            "MARCH",
+            "APRIL",
+            "MAY",
+            "JUNE",
+            "JULY",
+            "AUGUST",
+            "SEPTEMBER",
+            "OCTOBER",
+            "NOVEMBER",
+            "DECEMBER",
+        ]
+    )
+
+    _day_names = np.array(
+        [
+            "MONDAY",
+            "TUESDAY",
+            "WEDNESDAY",
+            "THURSDAY",
+            "FRIDAY",
+            "SATURDAY",
+            "SUNDAY",
+        ]
+    )
+
+    _calendars = {}
+
+    def __init__(self, date_keys, grain="day", cache_dir=None):
+        if grain not in self._grains:
+            raise ValueError(f"grain must be one of {self._grains}, not {grain}")
+
+        self.grain = grain
+        self.cache_dir = cache_dir
+        self.years = self._get_years(date_keys)
 
     def get_dimension(self):
-        month_name_short = [name[:3].upper() for name in self.date_range.month_name()]
-        month_name_long = [name.upper() for name in self.date_range.month_name()]
+        calendar = self._get_calendar()
 
-        week_day_name = [name.upper() for name in self.date_range.day_name()]
+        year_oldest, year_newest = self.years
+        in_years = calendar["Year_Number"].between(year_oldest, year_newest)
 
-        date_keys = self.date_range.astype("str").str.replace("-", "").astype(int)
+        return calendar[in_years].copy()
 
-        semester_number = [
-            self._get_semester_number(quarter) for quarter in self.date_range.quarter
-        ]
+    def _build_calendar(self, year_oldest, year_newest):
+        date_range = pd.date_range(
+            f"{year_oldest}-01-01", f"{year_newest}-12-31", freq="D"
+        )
+
+        if self.grain == "quarter":
+            date_range = date_range[date_range.is_quarter_end]
+
+        year = date_range.year
+        month = date_range.month
+        quarter = date_range.quarter
+        isocalendar = date_range.isocalendar()
+
+        month_name_long = self._month_names[month - 1]
+        month_name_short = month_name_long.astype("<U3")
 
         return pd.DataFrame(
             {
-                "Date_Keys": date_keys,
-                "Full_Date": self.date_range.date,
-                "Year_Number": self.date_range.year,
-                "Month_Number": self.date_range.month,
-                "Month_Name_Short": month_name_short,
-                "Month_Name_Long": month_name_long,
-                "Week_Number": self.date_range.isocalendar().week.values,
-                "Week_Day_Number": self.date_range.isocalendar().day,
-                "Week_Day_Name": week_day_name,
-                "Quarter_Number": self.date_range.quarter,
-                "Semester_Number": semester_number,
-                "Is_Month_Start": self.date_range.is_month_start,
-                "Is Month End": self.date_range.is_month_end,
-                "Is_Quarter_Start": self.date_range.is_quarter_start,
-                "Is Quarter End": self.date_range.is_quarter_end,
-                "Is_Year_Start": self.date_range.is_year_start,
-                "Is Year End": self.date_range.is_year_end,
+                "Date_Keys": year * 10000 + month * 100 + date_range.day,
+                "Full_Date": date_range.date,
+                "Year_Number": year,
+                "Month_Number": month,
+                "Month_Name_Short": month_name_short.astype(object),
+                "Month_Name_Long": month_name_long.astype(object),
+                "Week_Number": isocalendar.week.values,
+                "Week_Day_Number": isocalendar.day.values,
+                "Week_Day_Name": self._day_names[date_range.dayofweek].astype(object),
+                "Quarter_Number": quarter,
+                "Semester_Number": (quarter + 1) // 2,
+                "Is_Month_Start": date_range.is_month_start,
+                "Is Month End": date_range.is_month_end,
+                "Is_Quarter_Start": date_range.is_quarter_start,
+                "Is Quarter End": date_range.is_quarter_end,
+                "Is_Year_Start": date_range.is_year_start,
+                "Is Year End": date_range.is_year_end,
             }
         ).set_index("Date_Keys")
 
-    @staticmethod
-    def _get_date_range(date_keys):
-        as_str = date_keys.astype(str)
-        unique = as_str.sort_values().unique()
+    def _cache_path(self):
+        if self.cache_dir is None:
+            return None
 
-        year_oldest = unique[0][:4]
-        year_newest = unique[-1][:4]
+        return os.path.join(self.cache_dir, f"date_dimension_{self.grain}.pkl")
 
-        start = f"{year_oldest}-01-01"
-        end = f"{year_newest}-12-31"
+    def _get_calendar(self):
+        """cached calendar, extended by any years it lacks"""
+        calendar = self._load_calendar()
+        year_oldest, year_newest = self.years
 
-        return pd.date_range(start, end, freq="D")
+        if calendar is None:
+            calendar = self._build_calendar(year_oldest, year_newest)
+            self._store_calendar(calendar)
+            return calendar
+
+        cached_oldest = calendar["Year_Number"].iloc[0]
+        cached_newest = calendar["Year_Number"].iloc[-1]
+
+        if year_oldest >= cached_oldest and year_newest <= cached_newest:
+            return calendar
+
+        parts = [calendar]
+
+        if year_oldest < cached_oldest:
+            parts.insert(0, self._build_calendar(year_oldest, cached_oldest - 1))
+
+        if year_newest > cached_newest:
+            parts.append(self._build_calendar(cached_newest + 1, year_newest))
+
+        calendar = pd.concat(parts)
+        self._store_calendar(calendar)
+        return calendar
 
     @staticmethod
-    def _get_semester_number(quarter):
-        return {1: 1, 2: 1, 3: 2, 4: 2}[quarter]
+    def _get_years(date_keys):
+        years = pd.Index(date_keys).astype(str).str[:4].astype(int)
+        return years.min(), years.max()
+
+    def _load_calendar(self):
+        calendar = self._calendars.get(self.grain)
+        path = self._cache_path()
+
+        if calendar is None and path is not None and os.path.isfile(path):
+            calendar = pd.read_pickle(path)
+            self._calendars[self.grain] = calendar
+
+        return calendar
+
+    def _store_calendar(self, calendar):
+        self._calendars[self.grain] = calendar
+        path = self._cache_path()
+
+        if path is None:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        calendar.to_pickle(f"{path}.part")
+        os.replace(f"{path}.part", path)
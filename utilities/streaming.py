@@ -0,0 +1,155 @@
+from utilities.preprocessing import FlowExtractor, FlowStandardiser
+from utilities.data_cleaner import AnalysisCleaner
+from utilities import instrumentation
+import pandas as pd
+import pickle
+import shutil
+import json
+import os
+
+
+class FlowStreamingPreprocessor:
+    """run_preprocessing a quarter at a time: each workbook extracted and
+    standardised before the next is opened, the analysis sheet then cleaned
+    quarter by quarter, every quarter appended to a QuarterSink once done
+
+    quarters are standardised alone, which is what the batch path does
+    column by column; cleaning waits on the last workbook, as the batch
+    path upper cases any column held as text in any quarter. cis funds are
+    cleaned by CISFundsCleaner over all quarters, fund names resolved by
+    usage across them, and so stream no further than standardisation
+    """
+
+    def __init__(self, sink_dir, sheet_cache=None, log_listener=None):
+        self.sink = QuarterSink(sink_dir)
+        self.sheet_cache = sheet_cache
+        self.log_listener = log_listener
+
+    def run(self, excel_files, analysis_sheet="Analysis", **sheet_to_header_map):
+        """returns a list of sheets, as run_preprocessing, followed by the
+        analysis sheet cleaned, as AnalysisCleaner.analysis; each read back
+        from the sink once all workbooks are through
+        """
+        for _ in self.stream(excel_files, analysis_sheet, **sheet_to_header_map):
+            pass
+
+        tables = self._tables(analysis_sheet, sheet_to_header_map)
+        return [self.sink.read(table) for table in tables]
+
+    def stream(self, excel_files, analysis_sheet="Analysis", **sheet_to_header_map):
+        """generator of (table, date, quarter), each quarter yielded once in
+        the sink; a table per sheet standardised, and analysis_sheet cleaned
+        as analysis_sheet + "_Clean" where it is among the sheets
+        """
+        tables = self._tables(analysis_sheet, sheet_to_header_map)
+
+        for table in tables:
+            self.sink.clear(table)
+
+        extractor = FlowExtractor(
+            sheet_cache=self.sheet_cache, log_listener=self.log_listener
+        )
+        standardiser = FlowStandardiser()
+        object_columns = {}
+
+        for excel in excel_files:
+            with instrumentation.stage("stream_workbook") as record:
+                extracted = extractor.extract_workbooks([excel], **sheet_to_header_map)
+                record["rows_out"] = 0
+
+                for sheet_name, sheets in extracted.items():
+                    for date, sheet in sheets.items():
+                        quarter = standardiser.standardise({date: sheet})
+                        self.sink.append(sheet_name, date, quarter)
+                        record["rows_out"] += quarter.shape[0]
+
+                        if sheet_name == analysis_sheet:
+                            objects = quarter.dtypes == "object"
+                            object_columns[date] = set(quarter.columns[objects])
+
+                        yield sheet_name, date, quarter
+
+        if analysis_sheet not in sheet_to_header_map:
+            return
+
+        object_columns = set().union(*object_columns.values())
+
+        for date, quarter in self.sink.quarters(analysis_sheet):
+            clean = AnalysisCleaner(quarter, object_columns).analysis
+            self.sink.append(tables[-1], date, clean)
+            yield tables[-1], date, clean
+
+    @staticmethod
+    def _tables(analysis_sheet, sheet_to_header_map):
+        tables = list(sheet_to_header_map)
+
+        if analysis_sheet in sheet_to_header_map:
+            tables.append(f"{analysis_sheet}_Clean")
+
+        return tables
+
+
+class QuarterSink:
+    """append only store of tables a quarter at a time, each quarter pickled
+    to a file of its own, dtypes kept as they are, and listed in order of
+    arrival in a manifest per table
+
+    a quarter appended again replaces the one held, in its place, as
+    extract_workbooks keeps the last workbook of a quarter in the position
+    of the first
+    """
+
+    _manifest_name = "manifest.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, table, date, frame):
+        manifest = self._read_manifest(table)
+        filename = manifest.get(str(date), f"{len(manifest):05d}-{date}.pkl")
+
+        os.makedirs(self._path(table), exist_ok=True)
+
+        with open(self._path(table, f"{filename}.part"), "wb") as file:
+            pickle.dump(frame, file)
+
+        os.replace(self._path(table, f"{filename}.part"), self._path(table, filename))
+
+        manifest[str(date)] = filename
+        self._write_manifest(table, manifest)
+
+    def clear(self, table):
+        shutil.rmtree(self._path(table), ignore_errors=True)
+
+    def dates(self, table):
+        return list(self._read_manifest(table))
+
+    def quarters(self, table):
+        """generator of (date, frame), one quarter read at a time"""
+        for date, filename in self._read_manifest(table).items():
+            with open(self._path(table, filename), "rb") as file:
+                yield date, pickle.load(file)
+
+    def read(self, table):
+        """all quarters of table concatenated in order of arrival"""
+        frames = [frame for _, frame in self.quarters(table)]
+
+        if not frames:
+            raise FileNotFoundError(f"no quarters of table {table} in sink")
+
+        return pd.concat(frames)
+
+    def _path(self, table, *names):
+        return os.path.join(self.directory, table, *names)
+
+    def _read_manifest(self, table):
+        if not os.path.isfile(self._path(table, self._manifest_name)):
+            return {}
+
+        with open(self._path(table, self._manifest_name)) as file:
+            return json.load(file)
+
+    def _write_manifest(self, table, manifest):
+        with open(self._path(table, self._manifest_name), "w") as file:
+            json.dump(manifest, file, indent=1)
@@ -0,0 +1,182 @@
+from datetime import date
+import pandas as pd
+import numpy as np
+import io
+import os
+
+
+_month_ends = {3: 31, 6: 30, 9: 30, 12: 31}
+
+_sectors = [
+    (
+        "DEGN",
+        "South African – Equity – General",
+        "South African",
+        "Equity",
+        "General",
+    ),
+    (
+        "DAPL",
+        "South African – Multi Asset – Low Equity",
+        "South African",
+        "Multi Asset",
+        "Low Equity",
+    ),
+    (
+        "GIIN",
+        "Global – Interest Bearing – Short Term",
+        "Global",
+        "Interest Bearing",
+        "Short Term",
+    ),
+    (
+        "WAFL",
+        "Worldwide – Multi Asset – Flexible",
+        "Worldwide",
+        "Multi Asset",
+        "Flexible",
+    ),
+    (
+        "ASSET ALLOCATION",
+        "FCIS Asset Allocation Funds",
+        "FCIS",
+        "Asset",
+        "Allocation",
+    ),
+]
+
+_management_styles = ["Asset Manager", "Branded", "Broker", "tbc", None]
+
+
+def generate_workbooks(
+    quarters=8,
+    funds=50,
+    quarters_without_cis_funds=2,
+    last_quarter=(2023, 3),
+    seed=0,
+    directory=None,
+):
+    """Flow workbooks as published, newest quarter first, as scrape_excel
+    returns them; the oldest quarters_without_cis_funds lack a CISFunds
+    sheet. returned as bytes, or written to directory and paths returned
+
+    fund names carry stray whitespace and mixed case, one fund is renamed
+    part way and FCIS funds appear in CISFunds alone, as in the real data
+    """
+    workbooks = []
+
+    for position, quarter in enumerate(quarter_ends(quarters, last_quarter)):
+        with_cis_funds = position < quarters - quarters_without_cis_funds
+        workbook = generate_workbook(quarter, funds, with_cis_funds, seed + position)
+
+        if directory is None:
+            workbooks.append(workbook)
+            continue
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"flows_{quarter:%Y%m%d}.xlsx")
+
+        with open(path, "wb") as file:
+            file.write(workbook)
+
+        workbooks.append(path)
+
+    return workbooks
+
+
+def generate_workbook(quarter, funds=50, with_cis_funds=True, seed=0):
+    """one quarter's workbook as bytes: AA with the quarter ended banner,
+    Analysis at header row 0 and CISFunds at header row 2
+    """
+    random = np.random.default_rng(seed)
+    banner = f"Flows for the quarter ended {quarter.day} {quarter:%B} {quarter.year}"
+
+    with io.BytesIO() as buffer:
+        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+            pd.DataFrame([[None, banner, None], [1, 2, 3]]).to_excel(
+                writer, sheet_name="AA", header=False, index=False
+            )
+
+            _analysis(quarter, funds, random).to_excel(
+                writer, sheet_name="Analysis", index=False
+            )
+
+            if with_cis_funds:
+                pd.DataFrame([["CIS Funds"], [None]]).to_excel(
+                    writer, sheet_name="CISFunds", header=False, index=False
+                )
+                _cis_funds(quarter, funds).to_excel(
+                    writer, sheet_name="CISFunds", index=False, startrow=2
+                )
+
+        return buffer.getvalue()
+
+
+def quarter_ends(quarters, last_quarter=(2023, 3)):
+    """quarter end dates, newest first, from last_quarter as year, month"""
+    year, month = last_quarter
+    dates = []
+
+    for _ in range(quarters):
+        dates.append(date(year, month, _month_ends[month]))
+        month -= 3
+
+        if month == 0:
+            year, month = year - 1, 12
+
+    return dates
+
+
+def _analysis(quarter, funds, random):
+    fund = np.arange(funds)
+    sectors = [_sectors[i % 4] for i in fund]
+
+    return pd.DataFrame(
+        {
+            "CIS Manager": [f"Manager {i % 6}" for i in fund],
+            "Category1": [sector[2] for sector in sectors],
+            "Category2": [sector[3] for sector in sectors],
+            "Category3": [sector[4] for sector in sectors],
+            "Sector Name": [sector[1] for sector in sectors],
+            "Fundname": [_fund_name(i, quarter) for i in fund],
+            "Retail / Institutional": np.where(fund % 3 == 0, "I", "R"),
+            "Third Party": np.where(fund % 4 == 0, "TP", None),
+            "FoF": np.where(fund % 5 == 0, "FoF", None),
+            "Management Style": [_management_styles[i % 5] for i in fund],
+            "Total Assets": random.integers(1, 10**9, funds),
+            "Institutional Assets": random.integers(0, 10**6, funds),
+            "Net Flow (R)": random.integers(-(10**6), 10**6, funds),
+            "Net Flow (I)": random.integers(-(10**6), 10**6, funds),
+        }
+    )
+
+
+def _cis_funds(quarter, funds):
+    rows = []
+
+    for i in range(funds):
+        code, name = f"F{i:05d}", _fund_name(i, quarter).strip().upper()
+        rows.append((code, name, *_sectors[i % len(_sectors)][:2]))
+
+        if i == 3 and quarter.year >= 2022:
+            rows.append((code, "OLD FUND 3", *_sectors[i % len(_sectors)][:2]))
+
+    cis_funds = pd.DataFrame(
+        data=rows,
+        columns=["Fund Code", "Fund Name", "Sector Code", "Sector Name"],
+    )
+
+    cis_funds["Fund Type"] = "Retail"
+    cis_funds["FoF"] = "No"
+    cis_funds["Third Party Fund"] = "No"
+    cis_funds["Third Party Manager"] = None
+
+    return cis_funds
+
+
+def _fund_name(fund, quarter):
+    """fund 3 renamed from 2022, names padded and in mixed case"""
+    if fund == 3 and quarter.year < 2022:
+        return "Old Fund 3"
+
+    return f" Fund {fund} Balanced " if fund % 7 else f"fund {fund} income"
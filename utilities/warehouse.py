@@ -0,0 +1,204 @@
+import pandas as pd
+import numpy as np
+import sqlite3
+import time
+
+
+class FlowWarehouse:
+    """star schema of FlowStarSchema loaded into sqlite, a table per
+    dimension and one for the fact, named as in the excel export
+
+    a full load replaces every table; upsert inserts only dimension
+    members not yet present, matched on every column but the surrogate
+    key, as names alone repeat across codes, and fact rows of quarters not
+    yet present, their foreign keys remapped to the surrogate keys already
+    in the warehouse
+    """
+
+    _fact_name = "Fact_Assets"
+    _date_key = "Date_Key"
+    _date_dimension_key = "Date_Keys"
+
+    def __init__(self, database, batch_size=10000):
+        """database as path or sqlite3 connection"""
+        if isinstance(database, sqlite3.Connection):
+            self.connection = database
+        else:
+            self.connection = sqlite3.connect(database)
+
+        self.batch_size = batch_size
+
+    def close(self):
+        self.connection.close()
+
+    def load(self, star_schema, upsert=False):
+        """rows inserted and seconds taken per table, in one transaction"""
+        dimensions = dict(star_schema.get_tables(include_original=False))
+        fact = dimensions.pop(self._fact_name)
+
+        timings = []
+        remaps = {}
+
+        with self.connection:
+            self.connection.execute("BEGIN")
+
+            for name, dimension in dimensions.items():
+                start = time.perf_counter()
+
+                if upsert and self._table_exists(name):
+                    rows, remaps[dimension.index.name] = self._upsert_dimension(
+                        name, dimension
+                    )
+                else:
+                    rows = self._replace_table(name, dimension)
+
+                timings.append((name, rows, time.perf_counter() - start))
+
+            start = time.perf_counter()
+
+            if upsert and self._table_exists(self._fact_name):
+                rows = self._upsert_fact(fact, remaps)
+            else:
+                rows = self._replace_table(self._fact_name, fact)
+
+            timings.append((self._fact_name, rows, time.perf_counter() - start))
+
+        return pd.DataFrame(
+            data=timings,
+            columns=["Table", "Rows", "Seconds"],
+        ).set_index("Table")
+
+    def read_table(self, name):
+        return pd.read_sql(f'SELECT * FROM "{name}"', self.connection)
+
+    def _create_table(self, name, frame):
+        """surrogate key of a dimension as primary key, every key column of
+        the fact indexed
+        """
+        key = frame.index.name
+        columns = [f'"{key}" {self._sql_type(frame.index.dtype)}']
+
+        if name != self._fact_name:
+            columns[0] += " PRIMARY KEY"
+
+        for column, dtype in frame.dtypes.items():
+            columns.append(f'"{column}" {self._sql_type(dtype)}')
+
+        self.connection.execute(f'DROP TABLE IF EXISTS "{name}"')
+        self.connection.execute(f'CREATE TABLE "{name}" ({", ".join(columns)})')
+
+        if name != self._fact_name:
+            return
+
+        for column in [key] + [c for c in frame.columns if c.endswith("_Key")]:
+            self.connection.execute(
+                f'CREATE INDEX "ix_{name}_{column}" ON "{name}" ("{column}")'
+            )
+
+    def _insert(self, name, frame):
+        """executemany over batches of batch_size rows"""
+        frame = frame.reset_index()
+
+        columns = ", ".join(f'"{column}"' for column in frame.columns)
+        placeholders = ", ".join("?" for _ in frame.columns)
+        statement = f'INSERT INTO "{name}" ({columns}) VALUES ({placeholders})'
+
+        for start in range(0, frame.shape[0], self.batch_size):
+            batch = self._sql_values(frame.iloc[start : start + self.batch_size])
+            self.connection.executemany(
+                statement, batch.itertuples(index=False, name=None)
+            )
+
+        return frame.shape[0]
+
+    def _replace_table(self, name, frame):
+        self._create_table(name, frame)
+        return self._insert(name, frame)
+
+    @staticmethod
+    def _sql_type(dtype):
+        if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+            return "INTEGER"
+
+        if pd.api.types.is_float_dtype(dtype):
+            return "REAL"
+
+        return "TEXT"
+
+    @staticmethod
+    def _sql_values(frame):
+        """python objects sqlite3 binds, None for missing, dates as iso text"""
+        frame = frame.astype(object)
+
+        for column in frame.columns:
+            if pd.api.types.infer_dtype(frame[column], skipna=True) == "date":
+                frame[column] = frame[column].map(
+                    lambda date: None if pd.isna(date) else date.isoformat()
+                )
+
+        return frame.where(frame.notna(), None)
+
+    def _table_exists(self, name):
+        cursor = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,),
+        )
+        return cursor.fetchone() is not None
+
+    def _upsert_dimension(self, name, dimension):
+        """new members inserted under keys following the warehouse's,
+        returns rows inserted and the warehouse key of each dimension key
+        """
+        key = dimension.index.name
+
+        if key == self._date_dimension_key:
+            existing = self.read_table(name)[key]
+            new = ~dimension.index.isin(existing)
+            return self._insert(name, dimension[new]), None
+
+        existing = self.read_table(name)
+        natural = list(dimension.columns)
+
+        existing_unique = existing.drop_duplicates(subset=natural, keep="first")
+        members = _members(existing_unique[natural])
+
+        positions = members.get_indexer(_members(dimension[natural]))
+        new = positions == -1
+
+        key_next = existing[key].max() + 1 if existing.shape[0] else 1
+        keys = np.empty(dimension.shape[0], dtype=np.int64)
+        keys[~new] = existing_unique[key].to_numpy()[positions[~new]]
+        keys[new] = np.arange(key_next, key_next + new.sum())
+
+        new_members = dimension[new].copy()
+        new_members.index = pd.Index(keys[new], name=key)
+
+        remap = pd.Series(keys, index=dimension.index)
+        return self._insert(name, new_members), remap
+
+    def _upsert_fact(self, fact, remaps):
+        cursor = self.connection.execute(
+            f'SELECT DISTINCT "{self._date_key}" FROM "{self._fact_name}"'
+        )
+        quarters_loaded = [quarter for (quarter,) in cursor]
+
+        fact = fact[~fact.index.isin(quarters_loaded)].copy()
+
+        for key, remap in remaps.items():
+            if remap is not None and key in fact.columns:
+                fact[key] = fact[key].map(remap)
+
+        return self._insert(self._fact_name, fact)
+
+
+def _members(frame):
+    """a member per row, as a tuple of its values, NaN for null"""
+    columns = [_nan_for_null(frame[column]) for column in frame.columns]
+    return pd.Index(list(zip(*columns)), dtype=object, tupleize_cols=False)
+
+
+def _nan_for_null(series):
+    """sqlite hands back missing text as None, which no NaN would match"""
+    values = series.to_numpy(dtype=object, copy=True)
+    values[pd.isna(values)] = np.nan
+    return values